@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+
+# Prebuilt k-mer filter databases for kfilter.py.
+#
+# Each database file starts with a fixed-size header (magic, version, sub-k-mer size and the
+# number of k-mers in the database) followed by the data. Databases are memory-mapped read-only,
+# so concurrent kfilter.py runs against the same database share pages.
+
+# Imports
+import gzip
+import math
+import struct
+
+import numpy as np
+
+import kmercode
+
+# Constants
+HEADER_FORMAT = '<8sIIQ'
+BLOOM_FORMAT = '<QI'  # Follows HEADER_FORMAT: Number of blocks, number of hash functions
+HEADER_SIZE = 64
+VERSION = 1
+
+MAGIC_BITMAP = b'KFBITMAP'
+MAGIC_INDEX = b'KFINDEX\0'
+MAGIC_BLOOM = b'KFBLOOM\0'
+MAGIC_GZIP = b'\x1f\x8b'
+
+MAX_BITMAP_KSIZE = 16
+
+BLOOM_BLOCK_BITS = 512  # One 64-byte cache line per Bloom filter block
+BLOOM_BLOCK_WORDS = BLOOM_BLOCK_BITS // 64
+BLOOM_MAX_HASH = 16
+
+HASH_SEED_BLOCK = 0x9E3779B97F4A7C15
+HASH_SEED_BIT = 0xC2B2AE3D27D4EB4F
+
+READ_SIZE = 1 << 20  # Bytes of a bitmap counted at a time
+HASH_SIZE = 1 << 16  # Number of k-mers hashed at a time when building a Bloom filter
+
+# Globals
+bitCount = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Function: readHeader
+# Get (magic, version, sub-k-mer size, k-mer count) from a database file. Magic is None if the
+# file is not a filter database.
+def readHeader(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        header = inFile.read(HEADER_SIZE)
+
+    if len(header) < HEADER_SIZE or header[0:8] not in (MAGIC_BITMAP, MAGIC_INDEX, MAGIC_BLOOM):
+        return (None, 0, 0, 0)
+
+    return struct.unpack_from(HEADER_FORMAT, header)
+
+# Function: writeHeader
+def writeHeader(outFile, magic, subKSize, count):
+
+    outFile.write(struct.pack(HEADER_FORMAT, magic, VERSION, subKSize, count).ljust(HEADER_SIZE, b'\0'))
+
+# Function: isGzip
+def isGzip(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        return inFile.read(2) == MAGIC_GZIP
+
+# Function: readKmerFile
+# Iterate over blocks of k-mer codes from a KAnalyze k-mer file (one k-mer per line, optionally
+# followed by a tab and a count). The file may be gzipped.
+def readKmerFile(fileName, kSize):
+
+    if isGzip(fileName):
+        inFile = gzip.open(fileName, 'rb')
+    else:
+        inFile = open(fileName, 'rb')
+
+    try:
+        for (kmers, counts) in kmercode.readKmerBlocks(inFile, kSize):
+            yield kmers
+
+    finally:
+        inFile.close()
+
+# Function: openFilter
+# Open a prebuilt filter database. Returns None if the file is not a filter database.
+def openFilter(fileName):
+
+    (magic, version, subKSize, count) = readHeader(fileName)
+
+    if magic is None:
+        return None
+
+    if version != VERSION:
+        raise ValueError('Unsupported filter database version in {0}: {1}'.format(fileName, version))
+
+    if magic == MAGIC_BITMAP:
+        return BitmapFilter(fileName, subKSize, count)
+
+    if magic == MAGIC_INDEX:
+        return IndexFilter(fileName, subKSize, count)
+
+    if magic == MAGIC_BLOOM:
+        return BloomFilter(fileName, subKSize, count)
+
+    return None
+
+# Function: buildBitmap
+# Write a bitmap database from blocks of sub-k-mer codes.
+def buildBitmap(kmerBlocks, subKSize, outFileName):
+
+    if subKSize > MAX_BITMAP_KSIZE:
+        raise ValueError('Bitmap filters support sub-k-mers up to size {0}: {1}'.format(MAX_BITMAP_KSIZE, subKSize))
+
+    nByte = max((4 ** subKSize) // 8, 1)
+
+    with open(outFileName, 'wb') as outFile:
+        writeHeader(outFile, MAGIC_BITMAP, subKSize, 0)
+        outFile.truncate(HEADER_SIZE + nByte)
+
+    bitmap = np.memmap(outFileName, dtype=np.uint8, mode='r+', offset=HEADER_SIZE, shape=(nByte,))
+
+    for kmers in kmerBlocks:
+        np.bitwise_or.at(bitmap, kmers >> np.uint64(3), np.left_shift(1, kmers & np.uint64(7)).astype(np.uint8))
+
+    count = 0
+
+    for i in range(0, nByte, READ_SIZE):
+        count += int(bitCount[bitmap[i:(i + READ_SIZE)]].sum(dtype=np.uint64))
+
+    bitmap.flush()
+    del bitmap
+
+    with open(outFileName, 'r+b') as outFile:
+        writeHeader(outFile, MAGIC_BITMAP, subKSize, count)
+
+    return count
+
+# Function: buildIndex
+# Write a sorted index database from blocks of sub-k-mer codes. Blocks from KAnalyze are already
+# sorted and are written as they are read. The index is sorted on disk if they are not.
+def buildIndex(kmerBlocks, subKSize, outFileName):
+
+    dtype = kmercode.codeType(subKSize)
+    count = 0
+    lastKmer = None
+    isSorted = True
+
+    with open(outFileName, 'wb') as outFile:
+        writeHeader(outFile, MAGIC_INDEX, subKSize, 0)
+
+        for kmers in kmerBlocks:
+            if len(kmers) == 0:
+                continue
+
+            kmers = kmers.astype(dtype)
+
+            if isSorted:
+                isSorted = bool((kmers[1:] >= kmers[:-1]).all()) and (lastKmer is None or kmers[0] >= lastKmer)
+
+            lastKmer = kmers[-1]
+
+            outFile.write(kmers.tobytes())
+            count += len(kmers)
+
+    if not isSorted:
+        index = np.memmap(outFileName, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(count,))
+        index.sort()
+        index.flush()
+
+        del index
+
+    with open(outFileName, 'r+b') as outFile:
+        writeHeader(outFile, MAGIC_INDEX, subKSize, count)
+
+    return count
+
+# Function: bloomBits
+# Get the word index and bit mask of each hash function for each k-mer in a blocked Bloom filter.
+# Returns two arrays of shape (len(kmers), nHash).
+def bloomBits(kmers, nBlock, nHash):
+
+    block = kmercode.mixHash(kmers, HASH_SEED_BLOCK) % np.uint64(nBlock)
+    h = kmercode.mixHash(kmers, HASH_SEED_BIT)
+
+    # Double hashing inside the block
+    h1 = h & np.uint64(0xFFFFFFFF)
+    h2 = (h >> np.uint64(32)) | np.uint64(1)
+
+    with np.errstate(over='ignore'):
+        bit = (h1[:, None] + np.arange(nHash, dtype=np.uint64)[None, :] * h2[:, None]) % np.uint64(BLOOM_BLOCK_BITS)
+
+    word = block[:, None] * np.uint64(BLOOM_BLOCK_WORDS) + (bit >> np.uint64(6))
+    mask = np.left_shift(np.uint64(1), bit & np.uint64(63))
+
+    return (word, mask)
+
+# Function: bloomSize
+# Get the number of blocks and hash functions for a Bloom filter of count k-mers with a false
+# positive rate of fpr.
+def bloomSize(count, fpr):
+
+    if fpr <= 0 or fpr >= 1:
+        raise ValueError('False positive rate must be between 0 and 1: {0}'.format(fpr))
+
+    nBit = max(-count * math.log(fpr) / (math.log(2) ** 2), 1)
+    nBlock = int(math.ceil(nBit / BLOOM_BLOCK_BITS))
+    nHash = min(max(int(round(nBit / max(count, 1) * math.log(2))), 1), BLOOM_MAX_HASH)
+
+    return (nBlock, nHash)
+
+# Function: buildBloom
+# Write a blocked Bloom filter database from a sorted index database.
+def buildBloom(indexDb, fpr, outFileName):
+
+    (nBlock, nHash) = bloomSize(indexDb.count, fpr)
+    nWord = nBlock * BLOOM_BLOCK_WORDS
+
+    with open(outFileName, 'wb') as outFile:
+        header = struct.pack(HEADER_FORMAT, MAGIC_BLOOM, VERSION, indexDb.subKSize, indexDb.count) + struct.pack(BLOOM_FORMAT, nBlock, nHash)
+
+        outFile.write(header.ljust(HEADER_SIZE, b'\0'))
+        outFile.truncate(HEADER_SIZE + nWord * 8)
+
+    bloom = np.memmap(outFileName, dtype=np.uint64, mode='r+', offset=HEADER_SIZE, shape=(nWord,))
+
+    for i in range(0, indexDb.count, HASH_SIZE):
+        (word, mask) = bloomBits(indexDb.kmerArray[i:(i + HASH_SIZE)], nBlock, nHash)
+
+        np.bitwise_or.at(bloom, word.ravel(), mask.ravel())
+
+    bloom.flush()
+    del bloom
+
+    return (nBlock, nHash)
+
+# Class: KmerFilter (set of sub-k-mers to filter)
+class KmerFilter:
+
+    def __init__(self, subKSize, count):
+        self.subKSize = subKSize
+        self.count = count
+
+    def contains(self, kmers):
+        return np.zeros(len(kmers), dtype=bool)
+
+# Class: ArrayFilter (sorted array of sub-k-mer codes)
+class ArrayFilter(KmerFilter):
+    def __init__(self, kmerArray, subKSize):
+        KmerFilter.__init__(self, subKSize, len(kmerArray))
+
+        self.kmerArray = kmerArray
+
+    def contains(self, kmers):
+        return kmercode.inSorted(self.kmerArray, np.asarray(kmers).astype(self.kmerArray.dtype))
+
+# Class: BitmapFilter (memory-mapped bitmap with one bit for every possible sub-k-mer)
+class BitmapFilter(KmerFilter):
+    def __init__(self, fileName, subKSize, count):
+        KmerFilter.__init__(self, subKSize, count)
+
+        self.fileName = fileName
+        self.bitmap = np.memmap(fileName, dtype=np.uint8, mode='r', offset=HEADER_SIZE)
+
+    def contains(self, kmers):
+        kmers = np.asarray(kmers, dtype=np.uint64)
+
+        return ((self.bitmap[kmers >> np.uint64(3)] >> (kmers & np.uint64(7)).astype(np.uint8)) & 1).astype(bool)
+
+# Class: IndexFilter (memory-mapped sorted array of sub-k-mer codes)
+class IndexFilter(ArrayFilter):
+    def __init__(self, fileName, subKSize, count):
+        if count > 0:
+            kmerArray = np.memmap(fileName, dtype=kmercode.codeType(subKSize), mode='r', offset=HEADER_SIZE, shape=(count,))
+        else:
+            kmerArray = np.zeros(0, dtype=kmercode.codeType(subKSize))
+
+        ArrayFilter.__init__(self, kmerArray, subKSize)
+
+        self.fileName = fileName
+
+# Class: BloomFilter (memory-mapped blocked Bloom filter, verified by an exact filter)
+class BloomFilter(KmerFilter):
+    def __init__(self, fileName, subKSize, count):
+        KmerFilter.__init__(self, subKSize, count)
+
+        with open(fileName, 'rb') as inFile:
+            (self.nBlock, self.nHash) = struct.unpack_from(BLOOM_FORMAT, inFile.read(HEADER_SIZE), struct.calcsize(HEADER_FORMAT))
+
+        self.fileName = fileName
+        self.bloom = np.memmap(fileName, dtype=np.uint64, mode='r', offset=HEADER_SIZE, shape=(self.nBlock * BLOOM_BLOCK_WORDS,))
+        self.exactFilter = None
+
+        self.queryCount = 0
+        self.positiveCount = 0
+        self.verifiedCount = 0
+
+    def contains(self, kmers):
+        kmers = np.asarray(kmers, dtype=np.uint64)
+
+        (word, mask) = bloomBits(kmers, self.nBlock, self.nHash)
+        found = ((self.bloom[word] & mask) != 0).all(axis=1)
+
+        self.queryCount += len(kmers)
+        self.positiveCount += int(found.sum())
+
+        # Verify positives
+        if self.exactFilter is not None:
+            foundIndex = np.flatnonzero(found)
+            found[foundIndex] = self.exactFilter.contains(kmers[foundIndex])
+
+            self.verifiedCount += int(found.sum())
+
+        return found
@@ -4,8 +4,14 @@
 import argparse
 import sys
 import subprocess
-import gzip
 import os
+import multiprocessing
+import resource
+
+import numpy as np
+
+import filterdb
+import kmercode
 
 # Constants
 ERR_NONE = 0
@@ -24,36 +30,225 @@ def err(msg, ret):
 def errMsg(msg):
     print("{0}: {1}".format(sys.argv[0], msg))
 
-# Function: nextKmerTarget
-def nextKmerTarget(inFile):
+# Function: streamTarget
+# Iterate over blocks of target k-mers. Each block is a tuple of k-mer codes, indices and a
+# boolean array that is True for k-mers that pass the filter (None if filterDb is None).
+def streamTarget(args, filterDb):
     
-    line = inFile.readline()
-        
-    if (line == ''):
-        return None
+    if (args.native):
+        for (name, seq) in kmercode.readSeqs(args.inFileList, args.format):
+            yield screenRecord(seq, filterDb)
+    
+    else:
+        yield from streamKanalyze(args, args.inFileList, filterDb)
+
+# Function: screenRecord
+# Get a block of target k-mers from one sequence with the native k-mer streamer.
+def screenRecord(seq, filterDb):
+    
+    seqCodes = kmercode.encodeSeq(seq)
+    (kmers, pos) = kmercode.kmerCodes(seqCodes, kSize)
+    
+    if filterDb is not None:
+        keep = screenSeq(seqCodes, filterDb)[pos]
+    else:
+        keep = None
     
-    return line[0:subKSize]
+    return (kmers, pos + 1, keep)
 
-# Function: nextKmerFilter
-def nextKmerFilter(inFile):
+# Function: streamKanalyze
+# Iterate over blocks of target k-mers from KAnalyze "stream". Raises CalledProcessError if
+# KAnalyze fails.
+def streamKanalyze(args, inFileList, filterDb):
+    
+    kanCmd = [args.kanalyze + '/stream', '-k', str(kSize), '-f', args.format, '--stdout', '--index'] + inFileList
+    kanProc = subprocess.Popen(kanCmd, stdout=subprocess.PIPE)
+    
+    for (kmers, index) in kmercode.readKmerBlocks(kanProc.stdout, kSize):
+        yield (kmers, index, screenKmers(kmers, filterDb))
+    
+    kanProc.wait()
+    
+    if (kanProc.returncode != 0):
+        raise subprocess.CalledProcessError(kanProc.returncode, kanCmd)
+
+# Function: formatRows
+# Get the output rows of a block of target k-mers.
+def formatRows(kmers, index, keep):
+    
+    kmerList = kmercode.decodeKmers(kmers, kSize)
+    indexList = index.tolist()
+    
+    if keep is None:
+        return ''.join(['{0},1,{1}\n'.format(kmer, str(index)) for (kmer, index) in zip(kmerList, indexList)])
+    
+    return ''.join(['{0},{1},{2}\n'.format(kmer, str(1 if writeKmer else 0), str(index)) for (kmer, writeKmer, index) in zip(kmerList, keep.tolist(), indexList)])
+
+# Function: joinBlocks
+# Join blocks of target k-mers into one block.
+def joinBlocks(blocks):
+    
+    if len(blocks) == 0:
+        return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64), None)
+    
+    if blocks[0][2] is None:
+        keep = None
+    else:
+        keep = np.concatenate([block[2] for block in blocks])
     
-    line = inFile.readline()
+    return (np.concatenate([block[0] for block in blocks]), np.concatenate([block[1] for block in blocks]), keep)
+
+# Function: outputBlock
+# Get the output of a block of target k-mers: The block itself for columnar output or the CSV rows.
+def outputBlock(args, block):
+    
+    if (args.columnar):
+        return block
+    
+    return formatRows(*block)
+
+# Function: initJob
+# Set the arguments and filter of a worker process.
+def initJob(args, filterDb):
+    
+    global jobArgs
+    global jobFilterDb
+    
+    jobArgs = args
+    jobFilterDb = filterDb
+
+# Function: processChunk
+# Get the output of one chunk of the target in a worker process. A chunk is a sequence with the
+# native k-mer streamer or an input file with KAnalyze.
+def processChunk(chunk):
+    
+    if (jobArgs.native):
+        return outputBlock(jobArgs, screenRecord(chunk, jobFilterDb))
+    
+    return outputBlock(jobArgs, joinBlocks(list(streamKanalyze(jobArgs, [chunk], jobFilterDb))))
+
+# Function: streamOutput
+# Iterate over the output of the target (see outputBlock). With more than one job, chunks of the
+# target (by record or by input file) are processed by a pool of worker processes and returned in
+# input order. Workers are forked, so the filter is shared and not copied.
+def streamOutput(args, filterDb, jobs):
+    
+    if jobs <= 1:
+        for block in streamTarget(args, filterDb):
+            yield outputBlock(args, block)
         
-    if (line == ''):
+        return
+    
+    if (args.native):
+        chunks = (seq for (name, seq) in kmercode.readSeqs(args.inFileList, args.format))
+    else:
+        chunks = args.inFileList
+    
+    with multiprocessing.get_context('fork').Pool(jobs, initJob, (args, filterDb)) as pool:
+        yield from pool.imap(processChunk, chunks)
+
+# Function: screenKmers
+# Get a boolean array that is True for each k-mer with no sub-k-mer in the filter. Sub-k-mers are
+# only tested for k-mers that have not already been filtered.
+def screenKmers(kmers, filterDb):
+    
+    if filterDb is None:
         return None
     
-    return line[0:subKSize].decode()
+    keep = np.ones(len(kmers), dtype=bool)
+    checkIndex = np.arange(len(kmers))
+    
+    for i in range(kSize - subKSize + 1):
+        found = filterDb.contains(kmercode.subKmers(kmers[checkIndex], kSize, subKSize, i))
+        
+        keep[checkIndex[found]] = False
+        checkIndex = checkIndex[~found]
+        
+        if len(checkIndex) == 0:
+            break
+    
+    return keep
+
+# Function: screenSeq
+# Get a boolean array that is True for each k-mer start position in an encoded sequence if the
+# k-mer has no sub-k-mer in the filter. Each sub-k-mer of the sequence is found once and k-mers
+# are screened by counting filtered sub-k-mers in a sliding window.
+def screenSeq(seqCodes, filterDb):
+    
+    nSub = len(seqCodes) - subKSize + 1
+    nKmer = len(seqCodes) - kSize + 1
+    
+    if nKmer <= 0:
+        return np.zeros(0, dtype=bool)
+    
+    (subKmerArray, subPos) = kmercode.kmerCodes(seqCodes, subKSize)
+    
+    # Count filtered sub-k-mers up to each position
+    blocked = np.zeros(nSub + 1, dtype=np.int64)
+    blocked[subPos[filterDb.contains(subKmerArray)] + 1] = 1
+    blocked = np.cumsum(blocked)
+    
+    window = kSize - subKSize + 1
+    
+    return (blocked[window:(window + nKmer)] - blocked[:nKmer]) == 0
+
+# Function: targetSubKmers
+# Get the sorted distinct sub-k-mer codes of the target sequences.
+def targetSubKmers(args):
+    
+    subKmerList = [np.zeros(0, dtype=kmercode.codeType(subKSize))]
+    
+    for (name, seq) in kmercode.readSeqs(args.inFileList, args.format):
+        subKmerList.append(np.unique(kmercode.kmerCodes(kmercode.encodeSeq(seq), subKSize)[0].astype(kmercode.codeType(subKSize))))
+    
+    return np.unique(np.concatenate(subKmerList))
+
+# Function: readFilterKc
+# Read k-mers of the filter file that occur in the target sequences.
+def readFilterKc(args):
+    
+    if (verbose):
+        print('Getting sub-kmers of target sequence')
+    
+    try:
+        targetArray = targetSubKmers(args)
+    
+    except OSError as ex:
+        err('Error reading target sequence "{0}": {1}'.format(ex.filename, ex.strerror), ERR_IO)
+    
+    if (verbose):
+        print('Found {0} distinct target sub-k-mers'.format(len(targetArray)))
+        print('Filtering sub k-mers and loading filter')
+    
+    # Intersect filter with target sub-k-mers
+    filterList = [np.zeros(0, dtype=targetArray.dtype)]
+    
+    try:
+        for kmers in filterdb.readKmerFile(args.filterFileName, subKSize):
+            kmers = kmers.astype(targetArray.dtype)
+            
+            filterList.append(kmers[kmercode.inSorted(targetArray, kmers)])
+    
+    except OSError as ex:
+        err('Error reading filter file "{0}": {1}'.format(args.filterFileName, ex.strerror), ERR_IO)
+    
+    except ValueError as ex:
+        err('Error reading filter file "{0}": {1}'.format(args.filterFileName, ex), ERR_USAGE)
+    
+    filterArray = np.unique(np.concatenate(filterList))
+    
+    if (verbose):
+        print('Read {0} k-mers into filter memory'.format(len(filterArray)))
+    
+    return filterdb.ArrayFilter(filterArray, subKSize)
 
 # Main
 if __name__ == '__main__':
     
-    # Declarations
-    filterSet = set()
-    
     # Get command line arguments
     parser = argparse.ArgumentParser(description='K-mer filter')
 
-    parser.add_argument('inFileList', metavar='INPUT_FILE', nargs='+',
+    parser.add_argument('inFileList', metavar='INPUT_FILE', nargs='*',
                         help='List of input files.')
     
     parser.add_argument('-k', '--ksize', dest='kSize', default=21,
@@ -68,17 +263,44 @@ if __name__ == '__main__':
     parser.add_argument('-o', '--out', dest='outFileName', required=True,
                         help='Output file of filtered k-mers.')
 
+    parser.add_argument('-c', '--columnar', dest='columnar', default=False, action='store_true',
+                        help='Write a columnar binary k-mer table instead of CSV. The table holds packed k-mer codes, indices and filter flags and can be read by tester.py.')
+    
+    parser.add_argument('-C', '--nocolumnar', dest='columnar', action='store_false',
+                        help='Write k-mers, filter flags and indices as CSV (default).')
+    
     parser.add_argument('-r', '--filter', dest='filterFileName', default=None,
                         help='File of k-mers to be filtered. K-mers must be of the sub-kmer size.')
     
     parser.add_argument('-R', '--nofilter', dest='filterFileName', action='store_const', const=None,
                         help='Do not read a filter file. No k-mers are filtered (default).')
     
+    parser.add_argument('-b', '--buildbitmap', dest='buildBitmap', default=False, action='store_true',
+                        help='Build a bitmap filter database from the filter file (sub-k-mer size 16 or less) and write it to the output file. Bitmap databases may be given as the filter file.')
+    
+    parser.add_argument('-i', '--buildindex', dest='buildIndex', default=False, action='store_true',
+                        help='Build a sorted index filter database from the filter file and write it to the output file. Index databases may be given as the filter file.')
+    
+    parser.add_argument('-l', '--bloom', dest='bloomFileName', default=None,
+                        help='Bloom filter file. Sub-k-mers are screened by the Bloom filter and only positives are checked against the filter file, which must be an index filter database. The Bloom filter is built from the filter file if it does not exist.')
+    
+    parser.add_argument('-p', '--fpr', dest='fpr', default=0.01,
+                        help='False positive rate of Bloom filters built by this run (default = 0.01).')
+    
     parser.add_argument('-t', '--tempdir', dest='tempDirName', default='temp',
-                        help='Location of temporary files.')
+                        help='Location of temporary files (unused, target sub-k-mers are kept in memory).')
     
     parser.add_argument('-e', '--kanloc', dest='kanalyze', default='kanalyze',
-                        help='Location of KAnalyze. "count" and "stream" should be found in this directory.')
+                        help='Location of KAnalyze. "stream" should be found in this directory.')
+    
+    parser.add_argument('-n', '--native', dest='native', default=False, action='store_true',
+                        help='Generate target k-mers in-process instead of running KAnalyze "stream".')
+    
+    parser.add_argument('-N', '--nonative', dest='native', action='store_false',
+                        help='Generate target k-mers with KAnalyze "stream" (default).')
+    
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1,
+                        help='Number of processes filtering target k-mers. Work is split by record with the native k-mer streamer and by input file with KAnalyze (default = 1).')
     
     parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true',
                         help='Set verbose output')
@@ -87,31 +309,66 @@ if __name__ == '__main__':
                         help='No verbose output (default)')
     
     parser.add_argument('-z', '--filtergz', dest='filterGz', default=True, action='store_true',
-                        help='Filter file is gzipped (default).')
+                        help='Filter file is gzipped (unused, gzipped filter files are detected).')
     
     parser.add_argument('-Z', '--nofiltergz', dest='filterGz', action='store_false',
-                        help='Filter file is not gzipped.')
+                        help='Filter file is not gzipped (unused, gzipped filter files are detected).')
 
     args = parser.parse_args()
     
     verbose = args.verbose
     
-    # Set locations
-    # Note: Append PID to tempDirName. Use it as the temp file location for KAnalyze
-    tempDirName = args.tempDirName + "/temp.filter." + str(os.getpid())
-    targetSubKc = tempDirName + "/targetsub.kc"
+    try:
+        kSize = kmercode.checkKSize(args.kSize)
+        subKSize = kmercode.checkKSize(args.subKSize)
     
-    kSize = args.kSize
-    subKSize = args.subKSize
-
+    except ValueError as ex:
+        err(str(ex), ERR_USAGE)
+    
+    jobs = int(args.jobs)
+    
+    # Build filter database
+    if (args.buildBitmap or args.buildIndex):
+        dbType = 'bitmap' if args.buildBitmap else 'index'
+        
+        if args.filterFileName is None:
+            err('A filter file must be specified to build a {0} filter database'.format(dbType), ERR_USAGE)
+        
+        if (args.buildBitmap and subKSize > filterdb.MAX_BITMAP_KSIZE):
+            err('Bitmap filter databases require a sub-k-mer size of {0} or less: {1}'.format(filterdb.MAX_BITMAP_KSIZE, subKSize), ERR_USAGE)
+        
+        if (verbose):
+            print('Building {0} filter database {1} from {2}'.format(dbType, args.outFileName, args.filterFileName))
+        
+        try:
+            if (args.buildBitmap):
+                count = filterdb.buildBitmap(filterdb.readKmerFile(args.filterFileName, subKSize), subKSize, args.outFileName)
+            else:
+                count = filterdb.buildIndex(filterdb.readKmerFile(args.filterFileName, subKSize), subKSize, args.outFileName)
+        
+        except OSError as ex:
+            err('Error building {0} filter database "{1}": {2}'.format(dbType, args.outFileName, ex.strerror), ERR_IO)
+        
+        except ValueError as ex:
+            err('Error building {0} filter database "{1}": {2}'.format(dbType, args.outFileName, ex), ERR_USAGE)
+        
+        if (verbose):
+            print('Wrote {0} k-mers to {1} filter database'.format(count, dbType))
+        
+        sys.exit(ERR_NONE)
+    
+    if len(args.inFileList) == 0:
+        err('No input files', ERR_USAGE)
+    
+    if subKSize > kSize:
+        err('Sub-k-mer size ({0}) must not be greater than the k-mer size ({1})'.format(subKSize, kSize), ERR_USAGE)
     
     if (verbose):
-        print('Target sub k-mer file: {0}'.format(targetSubKc))
         print('Opening output file {0}'.format(args.outFileName))
   
     # Open output file
     try:
-        outFile = open(args.outFileName, 'w')
+        outFile = open(args.outFileName, 'wb' if args.columnar else 'w')
 
     except OSError as ex:
         err('Error opening output file "{0}": {1}'.format(args.outFileName, ex.strerror), ERR_IO)
@@ -121,130 +378,96 @@ if __name__ == '__main__':
     
     
     if args.filterFileName is not None:  # Filter file specified - Filter by k-mers in the specified file(s)
-        # Open filter file
+        # Open prebuilt filter database
         try:
-            if (args.filterGz):
-                filterFile = gzip.open(args.filterFileName, 'r')
-            else:
-                filterFile = open(args.filterFileName, 'r')
-    
+            filterDb = filterdb.openFilter(args.filterFileName)
+        
         except OSError as ex:
             err('Error opening filter file "{0}": {1}'.format(args.filterFileName, ex.strerror), ERR_IO)
         
-        if (verbose):
-            print('Writing sub-kmers of target sequence')
-    
-        # Write sub-kmer of target sequence
-        kanProc = subprocess.Popen([args.kanalyze + '/count', '-k', str(subKSize), '-t', tempDirName, '-f', args.format, '-o', targetSubKc] + args.inFileList)
-        
-        retcode = kanProc.wait()
-        
-        if (retcode != 0):
-            err('Target sub-kmer process terminated with code {0}'.format(retcode), retcode)
-        
-        if (verbose):
-            print('Opening full sub k-mer target file {0}'.format(targetSubKc))
-        
-        # Open sub-kmer file
-        try:
-            subKFile = open(targetSubKc, 'r')
-        
-        except OSError as ex:
-            err('Error opening sub k-mer file "{0}": {1}'.format(args.filterFileName, ex.strerror), ERR_IO)
+        except ValueError as ex:
+            err(str(ex), ERR_USAGE)
         
-        if (verbose):
-            print('Filtering sub k-mers and loading hash')
+        if filterDb is not None:
+            if (filterDb.subKSize != subKSize):
+                err('Filter database sub-k-mer size ({0}) does not match the sub-k-mer size ({1})'.format(filterDb.subKSize, subKSize), ERR_USAGE)
+            
+            if (verbose):
+                print('Opened filter database with {0} k-mers'.format(filterDb.count))
         
-        # Traverse filter and sub k-mer file
-        subKmer = nextKmerTarget(subKFile)
-        filterKmer = nextKmerFilter(filterFile)
+        else:
+            filterDb = readFilterKc(args)
         
-        while (subKmer != None and filterKmer != None):
+        # Open Bloom filter
+        if args.bloomFileName is not None:
+            
+            if not isinstance(filterDb, filterdb.IndexFilter):
+                err('A Bloom filter requires an index filter database as the filter file (see --buildindex)', ERR_USAGE)
             
-            if (subKmer == filterKmer):
-                filterSet.add(subKmer)
+            try:
+                if not os.path.exists(args.bloomFileName):
+                    if (verbose):
+                        print('Building Bloom filter {0} (false positive rate {1})'.format(args.bloomFileName, args.fpr))
+                    
+                    (nBlock, nHash) = filterdb.buildBloom(filterDb, float(args.fpr), args.bloomFileName)
+                    
+                    if (verbose):
+                        print('Wrote Bloom filter with {0} blocks and {1} hash functions'.format(nBlock, nHash))
                 
-                subKmer = nextKmerTarget(subKFile)
-                filterKmer = nextKmerFilter(filterFile)
+                bloomDb = filterdb.openFilter(args.bloomFileName)
             
-            elif (subKmer < filterKmer):
-                subKmer = nextKmerTarget(subKFile)
+            except OSError as ex:
+                err('Error opening Bloom filter "{0}": {1}'.format(args.bloomFileName, ex.strerror), ERR_IO)
             
-            else:
-                filterKmer = nextKmerFilter(filterFile)
-        
-        if (verbose):
-            print('Read {0} k-mers into hash memory'.format(len(filterSet)))
-            print('Closing sub k-mer file')
-                
-        subKFile.close()
-        
-        # Remove sub-k-mer file
-        if (verbose):
-            print('Removing temporary file: ' + targetSubKc)
-        
-        try:
-            os.remove(targetSubKc)
+            except ValueError as ex:
+                err('Error opening Bloom filter "{0}": {1}'.format(args.bloomFileName, ex), ERR_USAGE)
             
-        except:
-            errMsg('Warning: Error closing temporary file: ' + targetSubKc + ': ' + sys.exc_info()[0])
-        
-        # Remove temporary directory (fails if it contains files, which it will if k-analyze or removing the temporary file fails)
-        if (verbose):
-            print('Removing temporary directory: ' + tempDirName)
-        
-        try:
-            os.rmdir(tempDirName)
+            if not isinstance(bloomDb, filterdb.BloomFilter):
+                err('Not a Bloom filter: {0}'.format(args.bloomFileName), ERR_USAGE)
             
-        except:
-            errMsg('Warning: Error removing temporary directory: ' + tempDirName + ': ' + sys.exc_info()[0])
-        
-        if (verbose):
-            print('Closing filter file')
-        
-        filterFile.close()
+            if (bloomDb.subKSize != filterDb.subKSize or bloomDb.count != filterDb.count):
+                err('Bloom filter {0} was not built from filter file {1}'.format(args.bloomFileName, args.filterFileName), ERR_USAGE)
+            
+            bloomDb.exactFilter = filterDb
+            filterDb = bloomDb
         
         if (verbose):
             print('Processing target full k-mers')
-        
-        # Filter target by sub k-mers
-        kanProc = subprocess.Popen([args.kanalyze + '/stream', '-k', str(kSize), '-f', args.format, '--stdout', '--index'] + args.inFileList, stdout=subprocess.PIPE)
-        
-        for line in kanProc.stdout:
-            line = line.decode().strip()
-            tok = line.split('\t')
-            
-            if (len(tok) < 2):
-                continue
-            
-            writeKmer = True
-            
-            for i in range(len(tok[0]) - subKSize + 1):
-                
-                if (tok[0][i:(i + 16)] in filterSet):
-                    writeKmer = False
-            
-            outFile.write('{0},{1},{2}\n'.format(tok[0], str(1 if writeKmer else 0), str(tok[1])))
     
     else:  # Filter file not specified - Write all k-mers and filter none
+        filterDb = None
         
         if (verbose):
             print('Writing all k-mers and filtering none (no filter files specified)')
-        
-        # Filter target by sub k-mers
-        kanProc = subprocess.Popen([args.kanalyze + '/stream', '-k', str(kSize), '-f', args.format, '--stdout', '--index'] + args.inFileList, stdout=subprocess.PIPE)
-        
-        for line in kanProc.stdout:
-            line = line.decode().strip()
-            tok = line.split('\t')
+    
+    # Filter target by sub k-mers
+    try:
+        if (args.columnar):
+            (kmers, index, keep) = joinBlocks(list(streamOutput(args, filterDb, jobs)))
             
-            if (len(tok) < 2):
-                continue
+            if keep is None:
+                keep = np.ones(len(kmers), dtype=bool)
             
-            outFile.write('{0},1,{1}\n'.format(tok[0], str(tok[1])))
+            kmercode.writeKmerTable(outFile, kSize, kmers, index, keep)
+        
+        else:
+            for rows in streamOutput(args, filterDb, jobs):
+                outFile.write(rows)
+    
+    except subprocess.CalledProcessError as ex:
+        err('Target k-mer stream process terminated with code {0}'.format(ex.returncode), ex.returncode)
+    
+    except OSError as ex:
+        err('Error reading target sequence "{0}": {1}'.format(ex.filename, ex.strerror), ERR_IO)
+    
+    if (verbose and jobs <= 1 and isinstance(filterDb, filterdb.BloomFilter)):
+        print('Bloom filter: {0} sub-k-mers queried, {1} positive, {2} verified'.format(filterDb.queryCount, filterDb.positiveCount, filterDb.verifiedCount))
     
     if (verbose):
         print('Closing output file')
 
     outFile.close()
+    
+    if (verbose):
+        print('Peak memory: {0:.1f} MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
     
\ No newline at end of file
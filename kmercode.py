@@ -0,0 +1,621 @@
+#!/usr/bin/python3
+
+# Shared 2-bit k-mer encoding routines.
+#
+# Bases are encoded A=0, C=1, G=2, T/U=3. A k-mer of size k (k <= 32) is packed into an unsigned
+# 64-bit integer with the first base in the most significant position, so sorting codes sorts
+# k-mers lexicographically (the same order KAnalyze writes).
+
+# Imports
+import math
+import os
+import struct
+
+import numpy as np
+from Bio import SeqIO
+
+# Constants
+CODE_INVALID = 4
+MAX_KSIZE = 32
+
+READ_SIZE = 1 << 20  # Bytes read from a KAnalyze pipe at a time
+
+TABLE_MAGIC = b'SPKTABLE'
+TABLE_VERSION = 1
+TABLE_HEADER_FORMAT = '<8sIIQ'  # Magic, version, k-mer size, number of k-mers
+TABLE_HEADER_SIZE = 64
+
+CONS_MAGIC = b'SPKCONS\0'
+CONS_VERSION = 1
+CONS_HEADER_FORMAT = '<8sIIQQ'  # Magic, version, k-mer size, number of k-mers, number of genomes
+CONS_HEADER_SIZE = 64
+
+SKETCH_MAGIC = b'SPKSKTCH'
+SKETCH_VERSION = 1
+SKETCH_HEADER_FORMAT = '<8sIIIIQQ'  # Magic, version, k-mer size, depth, width, number of genomes, k-mers added
+SKETCH_HEADER_SIZE = 64
+
+SKETCH_SEED = 0x6A09E667F3BCC909  # Hash seed of the first Count-Min sketch row
+SKETCH_SEED_STEP = 0x9E3779B97F4A7C15  # Added to the seed for each following row
+
+PRESENCE_MAGIC = b'SPKPRES\0'
+PRESENCE_VERSION = 1
+PRESENCE_HEADER_FORMAT = '<8sIIQQ'  # Magic, version, k-mer size, number of k-mers, number of genomes
+PRESENCE_HEADER_SIZE = 64
+
+# Globals
+baseCode = np.full(256, CODE_INVALID, dtype=np.uint8)
+
+for (base, code) in (('A', 0), ('C', 1), ('G', 2), ('T', 3), ('U', 3)):
+    baseCode[ord(base)] = code
+    baseCode[ord(base.lower())] = code
+
+codeBase = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# Function: checkKSize
+def checkKSize(kSize):
+    kSize = int(kSize)
+
+    if kSize < 1 or kSize > MAX_KSIZE:
+        raise ValueError('K-mer size must be between 1 and {0}: {1}'.format(MAX_KSIZE, kSize))
+
+    return kSize
+
+# Function: encodeSeq
+def encodeSeq(seq):
+
+    if isinstance(seq, str):
+        seq = seq.encode()
+
+    return baseCode[np.frombuffer(seq, dtype=np.uint8)]
+
+# Function: kmerCodes
+# Get the code and 0-based start position of each k-mer in an encoded sequence. K-mers
+# containing a base other than A, C, G or T are skipped.
+def kmerCodes(seqCodes, kSize):
+
+    nKmer = len(seqCodes) - kSize + 1
+
+    if nKmer <= 0:
+        return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+
+    # Find windows without invalid bases
+    invalidCount = np.concatenate(([0], np.cumsum(seqCodes == CODE_INVALID)))
+    valid = (invalidCount[kSize:] - invalidCount[:-kSize]) == 0
+
+    # Roll bases into the k-mer codes
+    seqCodes = (seqCodes & 3).astype(np.uint64)
+    kmers = np.zeros(nKmer, dtype=np.uint64)
+
+    for i in range(kSize):
+        kmers <<= np.uint64(2)
+        kmers |= seqCodes[i:(i + nKmer)]
+
+    pos = np.flatnonzero(valid)
+
+    return (kmers[pos], pos)
+
+# Function: encodeKmers
+# Get the codes of a list of k-mer strings (str or bytes). All k-mers must be of size kSize and
+# contain only A, C, G, T or U.
+def encodeKmers(kmerList, kSize):
+
+    if len(kmerList) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    if isinstance(kmerList[0], bytes):
+        baseMatrix = encodeSeq(b''.join(kmerList))
+    else:
+        baseMatrix = encodeSeq(''.join(kmerList))
+
+    if len(baseMatrix) != len(kmerList) * kSize:
+        raise ValueError('K-mers must be of size {0}'.format(kSize))
+
+    baseMatrix = baseMatrix.reshape(len(kmerList), kSize)
+
+    if (baseMatrix == CODE_INVALID).any():
+        raise ValueError('K-mer contains a base other than A, C, G, T or U')
+
+    return packKmers(baseMatrix)
+
+# Function: packKmers
+# Get the codes of k-mers from a matrix of base codes with one k-mer in each row.
+def packKmers(baseMatrix):
+
+    baseMatrix = baseMatrix.astype(np.uint64)
+    kmers = np.zeros(baseMatrix.shape[0], dtype=np.uint64)
+
+    for i in range(baseMatrix.shape[1]):
+        kmers <<= np.uint64(2)
+        kmers |= baseMatrix[:, i]
+
+    return kmers
+
+# Function: codeType
+# Get the smallest unsigned type that holds k-mer codes of size kSize.
+def codeType(kSize):
+
+    return np.uint32 if kSize <= 16 else np.uint64
+
+# Function: subKmers
+# Get the codes of the sub-k-mers of size subKSize starting at offset in each k-mer.
+def subKmers(kmers, kSize, subKSize, offset):
+
+    shift = np.uint64(2 * (kSize - subKSize - offset))
+    mask = np.uint64((1 << (2 * subKSize)) - 1)
+
+    return ((kmers >> shift) & mask).astype(codeType(subKSize))
+
+# Function: reverseComplement
+# Get the codes of the reverse complements of k-mers.
+def reverseComplement(kmers, kSize):
+
+    kmers = ~np.asarray(kmers, dtype=np.uint64)
+    rcKmers = np.zeros(len(kmers), dtype=np.uint64)
+
+    for i in range(kSize):
+        rcKmers <<= np.uint64(2)
+        rcKmers |= kmers & np.uint64(3)
+        kmers >>= np.uint64(2)
+
+    return rcKmers
+
+# Function: mismatchCount
+# Get the number of mismatched bases (Hamming distance) between pairs of k-mer codes.
+def mismatchCount(kmers, otherKmers):
+
+    diff = np.asarray(kmers, dtype=np.uint64) ^ np.asarray(otherKmers, dtype=np.uint64)
+    diff = (diff | (diff >> np.uint64(1))) & np.uint64(0x5555555555555555)
+
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1, dtype=np.int64)
+
+# Function: mixHash
+# Scramble 64-bit k-mer codes (splitmix64 finalizer).
+def mixHash(kmers, seed):
+
+    with np.errstate(over='ignore'):
+        h = np.asarray(kmers, dtype=np.uint64) ^ np.uint64(seed)
+        h ^= h >> np.uint64(30)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(27)
+        h *= np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+
+    return h
+
+# Function: inSorted
+# Test each value for membership in a sorted array.
+def inSorted(sortedArray, values):
+
+    if len(sortedArray) == 0:
+        return np.zeros(len(values), dtype=bool)
+
+    index = np.searchsorted(sortedArray, values)
+    index[index == len(sortedArray)] = 0
+
+    return sortedArray[index] == values
+
+# Function: decodeKmers
+def decodeKmers(kmers, kSize):
+
+    shift = np.arange(2 * (kSize - 1), -1, -2, dtype=np.uint64)
+    baseMatrix = codeBase[(np.asarray(kmers, dtype=np.uint64)[:, None] >> shift) & np.uint64(3)]
+
+    return np.ascontiguousarray(baseMatrix).view('S{0}'.format(kSize)).ravel().astype('U{0}'.format(kSize)).tolist()
+
+# Function: readKmerBlocks
+# Iterate over blocks of (k-mer codes, values) from KAnalyze output, which has a k-mer and an
+# optional integer (index or count) separated by a tab on each line. Data is read from the binary
+# stream inFile in large blocks and split into columns in bulk. Values are 0 for lines without one.
+def readKmerBlocks(inFile, kSize, readSize=READ_SIZE):
+
+    remainder = b''
+
+    while True:
+        data = inFile.read(readSize)
+
+        if len(data) == 0:
+            break
+
+        data = remainder + data
+        lineEnd = data.rfind(b'\n') + 1
+
+        remainder = data[lineEnd:]
+
+        if lineEnd > 0:
+            yield parseKmerLines(data[:lineEnd], kSize)
+
+    if len(remainder.strip()) > 0:
+        yield parseKmerLines(remainder + b'\n', kSize)
+
+# Function: parseKmerLines
+# Get (k-mer codes, values) from a block of complete KAnalyze output lines. Lines shorter than
+# kSize are skipped.
+def parseKmerLines(data, kSize):
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    lineEnd = np.flatnonzero(buffer == ord('\n'))
+    lineStart = np.concatenate(([0], lineEnd[:-1] + 1))
+
+    lineKeep = (lineEnd - lineStart) >= kSize
+    lineStart = lineStart[lineKeep]
+    lineEnd = lineEnd[lineKeep]
+
+    # Get k-mers
+    baseMatrix = baseCode[buffer[lineStart[:, None] + np.arange(kSize)]]
+
+    if (baseMatrix == CODE_INVALID).any():
+        raise ValueError('K-mer contains a base other than A, C, G, T or U')
+
+    kmers = packKmers(baseMatrix)
+
+    # Get values (digits following the tab)
+    valueStart = lineStart + kSize + 1
+    valueLen = lineEnd - valueStart
+    values = np.zeros(len(lineStart), dtype=np.int64)
+
+    for i in range(max(int(valueLen.max(initial=0)), 0)):
+        digit = buffer[np.minimum(valueStart + i, len(buffer) - 1)].astype(np.int64) - ord('0')
+        isDigit = (i < valueLen) & (digit >= 0) & (digit <= 9)
+
+        values = np.where(isDigit, values * 10 + digit, values)
+
+    return (kmers, values)
+
+# Function: readSeqs
+# Iterate over (name, sequence) of each record in a list of sequence files.
+def readSeqs(inFileList, format='fasta'):
+
+    for fileName in inFileList:
+        for record in SeqIO.parse(fileName, format):
+            yield (record.id, str(record.seq))
+
+# Function: streamKmers
+# Iterate over (k-mer codes, 1-based positions) of each record in a list of sequence files.
+def streamKmers(inFileList, kSize, format='fasta'):
+
+    kSize = checkKSize(kSize)
+
+    for (name, seq) in readSeqs(inFileList, format):
+        (kmers, pos) = kmerCodes(encodeSeq(seq), kSize)
+
+        yield (kmers, pos + 1)
+
+# Function: isKmerTable
+def isKmerTable(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        return inFile.read(len(TABLE_MAGIC)) == TABLE_MAGIC
+
+# Function: writeKmerTable
+# Write a columnar k-mer table (the binary form of a *.filt.csv file) to a binary file. The header
+# is followed by k-mer codes (uint64), 1-based indices (uint64) and the filter flags packed into
+# bits, each column starting on an 8-byte boundary.
+def writeKmerTable(outFile, kSize, kmers, index, keep):
+
+    count = len(kmers)
+
+    outFile.write(struct.pack(TABLE_HEADER_FORMAT, TABLE_MAGIC, TABLE_VERSION, kSize, count).ljust(TABLE_HEADER_SIZE, b'\0'))
+    outFile.write(np.asarray(kmers, dtype=np.uint64).tobytes())
+    outFile.write(np.asarray(index, dtype=np.uint64).tobytes())
+    outFile.write(np.packbits(np.asarray(keep, dtype=bool)).tobytes())
+
+# Function: readKmerTable
+# Get (k-mer size, k-mer codes, indices, filter flags) from a columnar k-mer table. Columns are
+# memory-mapped read-only.
+def readKmerTable(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        (magic, version, kSize, count) = struct.unpack_from(TABLE_HEADER_FORMAT, inFile.read(TABLE_HEADER_SIZE))
+
+    if magic != TABLE_MAGIC:
+        raise ValueError('Not a k-mer table: {0}'.format(fileName))
+
+    if version != TABLE_VERSION:
+        raise ValueError('Unsupported k-mer table version in {0}: {1}'.format(fileName, version))
+
+    if count == 0:
+        return (kSize, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool))
+
+    kmers = np.memmap(fileName, dtype=np.uint64, mode='r', offset=TABLE_HEADER_SIZE, shape=(count,))
+    index = np.memmap(fileName, dtype=np.uint64, mode='r', offset=TABLE_HEADER_SIZE + 8 * count, shape=(count,))
+    keepBits = np.memmap(fileName, dtype=np.uint8, mode='r', offset=TABLE_HEADER_SIZE + 16 * count, shape=((count + 7) // 8,))
+
+    return (kSize, kmers, index, np.unpackbits(keepBits, count=count).astype(bool))
+
+# Function: isConsStore
+def isConsStore(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        return inFile.read(len(CONS_MAGIC)) == CONS_MAGIC
+
+# Function: writeConsStore
+# Write a conservation store: the raw number of genomes each k-mer occurs in and the number of
+# genomes counted. The header is followed by sorted k-mer codes (uint64) and counts (uint32). The
+# store is written to a temporary file and moved over fileName, so an existing store is replaced
+# only when the new one is complete.
+def writeConsStore(fileName, kSize, recordCount, kmers, counts):
+
+    tempFileName = fileName + '.tmp'
+
+    with open(tempFileName, 'wb') as outFile:
+        outFile.write(struct.pack(CONS_HEADER_FORMAT, CONS_MAGIC, CONS_VERSION, kSize, len(kmers), recordCount).ljust(CONS_HEADER_SIZE, b'\0'))
+        outFile.write(np.asarray(kmers, dtype=np.uint64).tobytes())
+        outFile.write(np.asarray(counts, dtype=np.uint32).tobytes())
+
+    os.replace(tempFileName, fileName)
+
+# Function: readConsStore
+# Get (k-mer size, number of genomes, k-mer codes, counts) from a conservation store. Columns are
+# memory-mapped read-only. The conservation score of a k-mer is its count over the number of
+# genomes.
+def readConsStore(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        (magic, version, kSize, count, recordCount) = struct.unpack_from(CONS_HEADER_FORMAT, inFile.read(CONS_HEADER_SIZE))
+
+    if magic != CONS_MAGIC:
+        raise ValueError('Not a conservation store: {0}'.format(fileName))
+
+    if version != CONS_VERSION:
+        raise ValueError('Unsupported conservation store version in {0}: {1}'.format(fileName, version))
+
+    if count == 0:
+        return (kSize, recordCount, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32))
+
+    kmers = np.memmap(fileName, dtype=np.uint64, mode='r', offset=CONS_HEADER_SIZE, shape=(count,))
+    counts = np.memmap(fileName, dtype=np.uint32, mode='r', offset=CONS_HEADER_SIZE + 8 * count, shape=(count,))
+
+    return (kSize, recordCount, kmers, counts)
+
+# Function: sketchCells
+# Get the counter of each row of a Count-Min sketch for each k-mer (shape (len(kmers), depth)) as
+# indices into the sketch table (depth rows of width counters).
+def sketchCells(kmers, width, depth):
+
+    cells = np.empty((len(kmers), depth), dtype=np.uint64)
+
+    for row in range(depth):
+        seed = (SKETCH_SEED + row * SKETCH_SEED_STEP) & 0xFFFFFFFFFFFFFFFF
+        cells[:, row] = mixHash(kmers, seed) % np.uint64(width) + np.uint64(row * width)
+
+    return cells
+
+# Function: isSketch
+def isSketch(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        return inFile.read(len(SKETCH_MAGIC)) == SKETCH_MAGIC
+
+# Function: writeSketch
+# Write a Count-Min sketch of the number of genomes each k-mer occurs in. The header is followed
+# by the table (uint32, depth rows of width counters). Like a conservation store, the sketch is
+# written to a temporary file and moved over fileName.
+def writeSketch(fileName, kSize, recordCount, total, width, depth, table):
+
+    tempFileName = fileName + '.tmp'
+
+    with open(tempFileName, 'wb') as outFile:
+        outFile.write(struct.pack(SKETCH_HEADER_FORMAT, SKETCH_MAGIC, SKETCH_VERSION, kSize, depth, width, recordCount, total).ljust(SKETCH_HEADER_SIZE, b'\0'))
+        outFile.write(np.asarray(table, dtype=np.uint32).tobytes())
+
+    os.replace(tempFileName, fileName)
+
+# Function: readSketch
+# Get (k-mer size, number of genomes, k-mers added, width, depth, table) from a Count-Min sketch
+# file. The table is memory-mapped read-only.
+def readSketch(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        (magic, version, kSize, depth, width, recordCount, total) = struct.unpack_from(SKETCH_HEADER_FORMAT, inFile.read(SKETCH_HEADER_SIZE))
+
+    if magic != SKETCH_MAGIC:
+        raise ValueError('Not a conservation sketch: {0}'.format(fileName))
+
+    if version != SKETCH_VERSION:
+        raise ValueError('Unsupported conservation sketch version in {0}: {1}'.format(fileName, version))
+
+    table = np.memmap(fileName, dtype=np.uint32, mode='r', offset=SKETCH_HEADER_SIZE, shape=(width * depth,))
+
+    return (kSize, recordCount, total, width, depth, table)
+
+# Function: presenceRowSize
+# Get the number of bytes in a row of a presence matrix with recordCount genomes.
+def presenceRowSize(recordCount):
+
+    return (recordCount + 7) // 8
+
+# Function: writePresence
+# Write a presence matrix: one row of bits for each k-mer with a bit set for each genome the k-mer
+# occurs in (np.packbits order, genome 0 in the most significant bit of the first byte). The header
+# is followed by the sorted k-mer codes (uint64) and the packed rows (uint8). Like writeConsStore,
+# an existing file is replaced only when the new one is complete.
+def writePresence(fileName, kSize, recordCount, kmers, bits):
+
+    tempFileName = fileName + '.tmp'
+
+    with open(tempFileName, 'wb') as outFile:
+        outFile.write(struct.pack(PRESENCE_HEADER_FORMAT, PRESENCE_MAGIC, PRESENCE_VERSION, kSize, len(kmers), recordCount).ljust(PRESENCE_HEADER_SIZE, b'\0'))
+        outFile.write(np.asarray(kmers, dtype=np.uint64).tobytes())
+        outFile.write(np.ascontiguousarray(bits, dtype=np.uint8).tobytes())
+
+    os.replace(tempFileName, fileName)
+
+# Function: readPresence
+# Get (k-mer size, number of genomes, k-mer codes, packed rows) from a presence matrix. Arrays are
+# memory-mapped read-only.
+def readPresence(fileName):
+
+    with open(fileName, 'rb') as inFile:
+        (magic, version, kSize, count, recordCount) = struct.unpack_from(PRESENCE_HEADER_FORMAT, inFile.read(PRESENCE_HEADER_SIZE))
+
+    if magic != PRESENCE_MAGIC:
+        raise ValueError('Not a presence matrix: {0}'.format(fileName))
+
+    if version != PRESENCE_VERSION:
+        raise ValueError('Unsupported presence matrix version in {0}: {1}'.format(fileName, version))
+
+    rowSize = presenceRowSize(recordCount)
+
+    if count == 0 or rowSize == 0:
+        return (kSize, recordCount, np.zeros(0, dtype=np.uint64), np.zeros((count, rowSize), dtype=np.uint8))
+
+    kmers = np.memmap(fileName, dtype=np.uint64, mode='r', offset=PRESENCE_HEADER_SIZE, shape=(count,))
+    bits = np.memmap(fileName, dtype=np.uint8, mode='r', offset=PRESENCE_HEADER_SIZE + 8 * count, shape=(count, rowSize))
+
+    return (kSize, recordCount, kmers, bits)
+
+# Function: presenceRows
+# Get the packed presence rows of k-mer codes from a presence matrix. Rows of k-mers not in the
+# matrix are all zero.
+def presenceRows(kmers, bits, values):
+
+    values = np.asarray(values, dtype=np.uint64)
+    rows = np.zeros((len(values), bits.shape[1]), dtype=np.uint8)
+
+    if len(kmers) == 0:
+        return rows
+
+    index = np.searchsorted(kmers, values)
+    index[index == len(kmers)] = 0
+
+    found = np.asarray(kmers)[index] == values
+    rows[found] = bits[index[found]]
+
+    return rows
+
+# Function: countRows
+# Get the number of bits set in each row of a packed bit matrix.
+def countRows(bits):
+
+    return np.unpackbits(np.asarray(bits, dtype=np.uint8), axis=1).sum(axis=1, dtype=np.int64)
+
+# Function: readConsText
+# Get (k-mer size, sorted k-mer codes, scores) from a text conservation file with a k-mer and a score
+# between 0 and 1 on each line. Empty lines and lines starting with '#' are skipped. If a k-mer is
+# listed more than once, its last score is used.
+def readConsText(fileName):
+
+    kmerList = []
+    scoreList = []
+
+    with open(fileName, 'r') as consFile:
+        for (lineCount, line) in enumerate(consFile, 1):
+
+            line = line.strip()
+
+            if len(line) == 0 or line[0] == '#':
+                continue
+
+            tok = line.split(',')
+            score = float(tok[1])
+
+            if score < 0 or score > 1:
+                raise ValueError('Bad conservation record on line {0} ({1}): Entry must be between 0 and 1: {2}'.format(lineCount, fileName, tok[1]))
+
+            kmerList.append(tok[0])
+            scoreList.append(score)
+
+    if len(kmerList) == 0:
+        return (0, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.float64))
+
+    kSize = len(kmerList[0])
+    kmers = encodeKmers(kmerList, kSize)
+
+    # Sort, keeping the last score of each k-mer
+    order = np.argsort(kmers, kind='stable')
+    kmers = kmers[order]
+    last = np.flatnonzero(np.concatenate((kmers[1:] != kmers[:-1], [True])))
+
+    return (kSize, kmers[last], np.asarray(scoreList, dtype=np.float64)[order[last]])
+
+# Class: ConsScores (conservation score lookup)
+# Conservation scores from a conservation store or a text conservation file, looked up by binary
+# search over the sorted k-mer codes. Store columns are memory-mapped and scores are derived from
+# the counts when looked up.
+class ConsScores:
+
+    def __init__(self, fileName):
+
+        self.fileName = fileName
+        self.sketch = None
+        self.isEstimate = False  # Scores are upper-bound estimates (see errorBound)
+
+        if isConsStore(fileName):
+            (self.kSize, self.__divisor, self.kmers, self.__values) = readConsStore(fileName)
+        elif isSketch(fileName):
+            (self.kSize, self.__divisor, self.__total, self.__width, self.__depth, self.sketch) = readSketch(fileName)
+            self.isEstimate = True
+        else:
+            (self.kSize, self.kmers, self.__values) = readConsText(fileName)
+            self.__divisor = 1
+
+    # Get (found, scores) of an array of k-mer codes. Scores of k-mers not found are 0. Scores from
+    # a sketch are estimates (never below the exact score).
+    def lookup(self, kmers):
+
+        kmers = np.asarray(kmers, dtype=np.uint64)
+        scores = np.zeros(len(kmers), dtype=np.float64)
+
+        if self.sketch is not None:
+            if len(kmers) == 0:
+                return (np.zeros(0, dtype=bool), scores)
+
+            estimates = np.minimum(self.sketch[sketchCells(kmers, self.__width, self.__depth)].min(axis=1), self.__divisor)
+
+            found = estimates > 0
+            scores[found] = estimates[found] / self.__divisor
+
+            return (found, scores)
+
+        if len(self.kmers) == 0:
+            return (np.zeros(len(kmers), dtype=bool), scores)
+
+        index = np.searchsorted(self.kmers, kmers)
+        index[index == len(self.kmers)] = 0
+
+        found = self.kmers[index] == kmers
+        scores[found] = self.__values[index[found]] / self.__divisor
+
+        return (found, scores)
+
+    # Get (error, probability): scores exceed exact scores by at most error with the probability.
+    # Scores from a conservation store or text file are exact.
+    def errorBound(self):
+
+        if not self.isEstimate:
+            return (0.0, 1.0)
+
+        return (math.e / self.__width * self.__total / max(self.__divisor, 1), 1 - math.exp(-self.__depth))
+
+    # Get a note that scores are upper-bound estimates with their error bound, or None if scores are
+    # exact.
+    def estimateNote(self):
+
+        if not self.isEstimate:
+            return None
+
+        (error, probability) = self.errorBound()
+
+        return 'Scores from sketch "{0}" (width={1} depth={2}) are upper-bound estimates: they exceed exact scores by at most {3:.4g} with probability {4:.4g}'.format(self.fileName, self.__width, self.__depth, error, probability)
+
+    # Get (found, scores) of a list of k-mer strings. K-mers of another size or with bases other
+    # than A, C, G, T or U are not found.
+    def lookupStr(self, kmerList):
+
+        found = np.zeros(len(kmerList), dtype=bool)
+        scores = np.zeros(len(kmerList), dtype=np.float64)
+
+        valid = np.asarray([len(kmer) == self.kSize for kmer in kmerList], dtype=bool)
+
+        if not valid.any():
+            return (found, scores)
+
+        baseMatrix = encodeSeq(''.join([kmer for (kmer, isValid) in zip(kmerList, valid) if isValid])).reshape(-1, self.kSize)
+        valid[valid] = ~(baseMatrix == CODE_INVALID).any(axis=1)
+        baseMatrix = baseMatrix[~(baseMatrix == CODE_INVALID).any(axis=1)]
+
+        (found[valid], scores[valid]) = self.lookup(packKmers(baseMatrix))
+
+        return (found, scores)
@@ -3,13 +3,25 @@
 import argparse
 import sys
 import re
-from collections import defaultdict
+
+import kmercode
 
 #Constants
 ERR_NONE = 0
 ERR_USAGE = 1
 ERR_IO = 2
 
+BLOCK_SIZE = 65536  # Number of query lines looked up at a time
+
+#Function: printScores
+#Print query lines with the conservation score of their first field, looking up a block of k-mers at once.
+def printScores(consScores, lineList):
+	
+	scores = consScores.lookupStr([line.split(',')[0] for line in lineList])[1]
+	
+	for (line, score) in zip(lineList, scores):
+		print (line, score, sep=',')
+
 #Main 
 if (__name__ == '__main__'):
 
@@ -30,29 +42,27 @@ if (__name__ == '__main__'):
 	
 	args = parser.parse_args()
 	
-	#Open input file
-inFile = open(args.inFileName, 'rt')
+	#Read conservation (text file or conservation store, looked up by binary search over sorted k-mer codes)
+consScores = kmercode.ConsScores(args.inFileName)
+
+if consScores.isEstimate:
+	print('{0}: Warning: {1}'.format(sys.argv[0], consScores.estimateNote()), file=sys.stderr)
 	
 	#Write header line
 	#outFile.write('Kmer,Rev,Score')
 
-#Create Dictionary                      
-a = defaultdict(float)
-                      
-for line in inFile:
-        tok = line.strip().split(',')
-        if not line.find("#"):
-            continue
-        if len(tok)<2:
-            continue
-        a[tok[0]] = float(tok[1])
-                      
-print (a['TCTAACGCAACATAATAAACT'])
-
 query = open(args.queryFileName)
 
+lineList = []
+
 for line in query:
-	tok = line.strip().split(',')
 	if not line.find("#"):
-	continue
-	print (line
+		continue
+	lineList.append(line.strip())
+	
+	if len(lineList) >= BLOCK_SIZE:
+		printScores(consScores, lineList)
+		lineList = []
+
+if len(lineList) > 0:
+	printScores(consScores, lineList)
@@ -2,11 +2,36 @@
 
 # Imports
 import argparse
+import struct
 import subprocess
 import sys
 import os
+import math
+import itertools
+import multiprocessing
+import multiprocessing.util
 from Bio import SeqIO
 
+import numpy as np
+
+import kmercode
+
+# Constants
+ERR_NONE = 0
+ERR_USAGE = 1
+ERR_IO = 2
+
+MERGE_SIZE = 1 << 22  # Number of pending k-mers that triggers a merge of k-mer counts
+BATCH_SIZE = 32  # Number of genomes counted by a worker process at a time
+MATCH_BLOCK_SIZE = 1 << 16  # Number of genome k-mers matched against a seed index at a time
+MERGE_BLOCK_SIZE = 1 << 20  # Number of k-mers read from each conservation store at a time when merging shards
+
+CHECKPOINT_MAGIC = b'SPKCKPT\0'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_HEADER_FORMAT = '<8sIIQQqqQq'  # Magic, version, k-mer size, number of k-mers, number of genomes, file index, record index, genomes skipped, genome index
+CHECKPOINT_HEADER_SIZE = 64
+
+
 # Function: err
 def err(msg, ret):
     errMsg(msg)
@@ -16,21 +41,688 @@ def err(msg, ret):
 def errMsg(msg):
     print('{0}: {1}'.format(sys.argv[0], msg))
 
+# Function: streamGenomes
+# Iterate over the genomes of the input files as (file index, record index, genome index, genome).
+# A genome is a record sequence in multi-sequence mode or a file name otherwise, and None for a
+# record that could not be parsed (the rest of its file is skipped). The genome index counts
+# genomes over all files. Genomes up to and including the (file index, record index, genome index)
+# position start are skipped. With a (shard index, shard count) shard, only every shard count-th
+# genome starting at shard index is counted.
+def streamGenomes(args, start=(-1, -1, -1), shard=(0, 1)):
+    
+    genomeIndex = -1
+    
+    for (fileIndex, file) in enumerate(args.inFileList):
+        
+        if not args.multiSeq:
+            genomeIndex += 1
+        
+        if fileIndex < start[0] or (not args.multiSeq and genomeIndex % shard[1] != shard[0]):
+            continue
+        
+        # Records of skipped files are not read: continue from the genome index of the start position
+        if args.multiSeq and fileIndex == start[0]:
+            genomeIndex = start[2] - start[1] - 1
+        
+        if args.verbose:
+            print('Opening sequence file: ' + file)
+        
+        if args.multiSeq:
+            
+            inFile = open(file)
+            records = SeqIO.parse(inFile, args.format)
+            index = -1
+            
+            while True:
+                try:
+                    record = next(records, None)
+                
+                except ValueError as ex:
+                    record = ex
+                
+                if record is None:
+                    break
+                
+                genomeIndex += 1
+                index += 1
+                
+                if (fileIndex, index) > start[:2] and genomeIndex % shard[1] == shard[0]:
+                    
+                    # The parser cannot continue past a bad record: skip it (see countGenome) and the rest of the file
+                    if isinstance(record, ValueError):
+                        errMsg('Warning: Skipping record {0} and the rest of "{1}": {2}'.format(index + 1, file, record))
+                        yield (fileIndex, index, genomeIndex, None)
+                    
+                    else:
+                        yield (fileIndex, index, genomeIndex, str(record.seq))
+                
+                if isinstance(record, ValueError):
+                    break
+            
+            inFile.close()
+        
+        elif (fileIndex, 0) > start[:2]:
+            yield (fileIndex, 0, genomeIndex, file)
+
+# Function: genomeKmers
+# Get the sorted distinct k-mer codes of a genome (see streamGenomes). Raises CalledProcessError if
+# KAnalyze fails.
+def genomeKmers(args, genome, kSize):
+    
+    if args.multiSeq:
+        if args.native:
+            return recordKmers(genome, kSize)
+        
+        kanCmd = [args.kanalyze + '/count', '-k', str(kSize), '-t', jobTempDirName, '--stdout', '--input', genome]
+    
+    else:
+        if args.native:
+            return np.unique(np.concatenate([np.zeros(0, dtype=np.uint64)] + [recordKmers(seq, kSize) for (name, seq) in kmercode.readSeqs([genome], args.format)]))
+        
+        kanCmd = [args.kanalyze + '/count', '-k', str(kSize), '-t', jobTempDirName, '-f', args.format, '--stdout', genome]
+    
+    return countKanalyze(kanCmd, kSize)
+
+# Function: targetKmers
+# Get the sorted distinct k-mer codes of the target sequences and their reverse complements.
+def targetKmers(targetFileName, format, kSize):
+    
+    kmerList = [np.zeros(0, dtype=np.uint64)]
+    
+    for (name, seq) in kmercode.readSeqs([targetFileName], format):
+        kmers = recordKmers(seq, kSize)
+        
+        kmerList.append(kmers)
+        kmerList.append(kmercode.reverseComplement(kmers, kSize))
+    
+    return np.unique(np.concatenate(kmerList))
+
+# Function: restrictKmers
+# Get the target k-mers matched by k-mers (see TargetIndex.match), or all k-mers without a target.
+def restrictKmers(kmers, targetIndex):
+    
+    if targetIndex is None:
+        return kmers
+    
+    return targetIndex.match(kmers)
+
+# Function: countKanalyze
+# Get the k-mer codes output by one KAnalyze count process. Raises CalledProcessError if KAnalyze
+# fails.
+def countKanalyze(kanCmd, kSize):
+    
+    kanProc = subprocess.Popen(kanCmd, stdout=subprocess.PIPE)
+    
+    kmerList = [kmers for (kmers, counts) in kmercode.readKmerBlocks(kanProc.stdout, kSize)]
+    
+    kanProc.wait()
+    
+    if (kanProc.returncode != 0):
+        raise subprocess.CalledProcessError(kanProc.returncode, kanCmd)
+    
+    return np.concatenate([np.zeros(0, dtype=np.uint64)] + kmerList)
+
+# Function: recordKmers
+# Get the sorted distinct k-mer codes of a sequence.
+def recordKmers(seq, kSize):
+    
+    return np.unique(kmercode.kmerCodes(kmercode.encodeSeq(seq), kSize)[0])
+
+# Function: batchGenomes
+# Iterate over lists of up to batchSize genomes as (file index, record index, genome).
+def batchGenomes(genomes, batchSize):
+    
+    batch = []
+    
+    for genome in genomes:
+        batch.append(genome)
+        
+        if len(batch) == batchSize:
+            yield batch
+            batch = []
+    
+    if len(batch) > 0:
+        yield batch
+
+# Function: initJob
+# Set the arguments, k-mer size, target index and Count-Min sketch (None if not used) of a worker
+# process. Each worker running KAnalyze gets its own temporary directory (concurrent KAnalyze runs
+# write segment files with the same names), which is removed when the worker exits (see endJob).
+def initJob(args, kSize, targetIndex, sketch):
+    
+    global jobArgs
+    global jobKSize
+    global jobTargetIndex
+    global jobSketch
+    global jobTempDirName
+    
+    jobArgs = args
+    jobKSize = kSize
+    jobTargetIndex = targetIndex
+    jobSketch = sketch
+    jobTempDirName = None
+    
+    if not args.native:
+        jobTempDirName = tempDirName + '/' + str(os.getpid())
+        os.makedirs(jobTempDirName, exist_ok=True)
+        
+        multiprocessing.util.Finalize(None, endJob, exitpriority=0)
+
+# Function: endJob
+# Remove the temporary directory of a worker process (or of in-process counting after initJob).
+def endJob():
+    
+    global jobTempDirName
+    
+    if jobTempDirName is None:
+        return
+    
+    try:
+        os.rmdir(jobTempDirName)
+    
+    except OSError as ex:
+        errMsg('Warning: Error removing temporary directory: ' + jobTempDirName + ': ' + str(ex))
+    
+    jobTempDirName = None
+
+# Function: countGenome
+# Get the k-mers of a genome to count (the target k-mers it matches, or its sketch cells). Returns
+# None and logs a warning if the genome cannot be counted, so a bad record is skipped without
+# adding any of its k-mers.
+def countGenome(args, fileIndex, recordIndex, genome, kSize, targetIndex, sketch):
+    
+    # Record could not be parsed (logged by streamGenomes)
+    if genome is None:
+        return None
+    
+    try:
+        kmers = genomeKmers(args, genome, kSize)
+    
+    except subprocess.CalledProcessError as ex:
+        errMsg('Warning: Skipping record {0} of "{1}": KAnalyze died with return code {2}'.format(recordIndex + 1, args.inFileList[fileIndex], ex.returncode))
+        return None
+    
+    except ValueError as ex:
+        errMsg('Warning: Skipping record {0} of "{1}": {2}'.format(recordIndex + 1, args.inFileList[fileIndex], ex))
+        return None
+    
+    if sketch is not None:
+        return sketch.cells(kmers)
+    
+    return restrictKmers(kmers, targetIndex)
+
+# Function: countBatch
+# Count k-mers of a list of genomes (see batchGenomes), in a worker process or in-process after
+# initJob. Returns the sorted k-mer codes, the number of genomes each occurs in, the number of
+# genomes counted, the packed presence rows of the k-mer codes with one column for each genome
+# counted if a presence matrix is written (otherwise None), the (file index, record index, genome
+# index) of the last genome and the number of genomes skipped. With a Count-Min sketch, sorted sketch cells and the counts to add to them
+# are returned instead of k-mers.
+def countBatch(genomeList):
+    
+    kmerCounter = KmerCounter()
+    kmerList = []
+    skipCount = 0
+    
+    for (fileIndex, recordIndex, genomeIndex, genome) in genomeList:
+        kmers = countGenome(jobArgs, fileIndex, recordIndex, genome, jobKSize, jobTargetIndex, jobSketch)
+        
+        if kmers is None:
+            skipCount += 1
+            continue
+        
+        kmerList.append(kmers)
+        kmerCounter.add(kmers)
+    
+    kmerCounter.merge()
+    
+    bits = None
+    
+    if jobArgs.presenceFileName is not None:
+        bits = np.zeros((len(kmerCounter.kmers), kmercode.presenceRowSize(len(kmerList))), dtype=np.uint8)
+        
+        for (genome, kmers) in enumerate(kmerList):
+            bits[np.searchsorted(kmerCounter.kmers, kmers), genome >> 3] |= np.uint8(0x80 >> (genome & 7))
+    
+    return (kmerCounter.kmers, kmerCounter.counts, len(genomeList) - skipCount, bits, tuple(genomeList[-1][:3]), skipCount)
+
+# Function: writeCheckpoint
+# Write a checkpoint: counts so far and the position of the last genome counted. Like a conservation
+# store, the header is followed by sorted k-mer codes (uint64) and counts (uint32), and an existing
+# checkpoint is replaced only when the new one is complete.
+def writeCheckpoint(fileName, kSize, recordCount, skipCount, position, kmers, counts):
+    
+    tempFileName = fileName + '.tmp'
+    
+    with open(tempFileName, 'wb') as outFile:
+        outFile.write(struct.pack(CHECKPOINT_HEADER_FORMAT, CHECKPOINT_MAGIC, CHECKPOINT_VERSION, kSize, len(kmers), recordCount, position[0], position[1], skipCount, position[2]).ljust(CHECKPOINT_HEADER_SIZE, b'\0'))
+        outFile.write(np.asarray(kmers, dtype=np.uint64).tobytes())
+        outFile.write(np.asarray(counts, dtype=np.uint32).tobytes())
+    
+    os.replace(tempFileName, fileName)
+
+# Function: readCheckpoint
+# Get (k-mer size, number of genomes, genomes skipped, (file index, record index, genome index),
+# k-mer codes, counts) from a checkpoint.
+def readCheckpoint(fileName):
+    
+    with open(fileName, 'rb') as inFile:
+        (magic, version, kSize, count, recordCount, fileIndex, recordIndex, skipCount, genomeIndex) = struct.unpack_from(CHECKPOINT_HEADER_FORMAT, inFile.read(CHECKPOINT_HEADER_SIZE))
+        
+        if magic != CHECKPOINT_MAGIC:
+            raise ValueError('Not a checkpoint: {0}'.format(fileName))
+        
+        if version != CHECKPOINT_VERSION:
+            raise ValueError('Unsupported checkpoint version in {0}: {1}'.format(fileName, version))
+        
+        kmers = np.fromfile(inFile, dtype=np.uint64, count=count)
+        counts = np.fromfile(inFile, dtype=np.uint32, count=count)
+    
+    return (kSize, recordCount, skipCount, (fileIndex, recordIndex, genomeIndex), kmers, counts)
+
+# Function: parseShard
+# Get (shard index, shard count) from a shard argument "i/N" (0 <= i < N).
+def parseShard(shard):
+    
+    tok = shard.split('/')
+    
+    if len(tok) != 2:
+        raise ValueError('Shard must be given as INDEX/COUNT: {0}'.format(shard))
+    
+    (shardIndex, shardCount) = (int(tok[0]), int(tok[1]))
+    
+    if shardCount < 1 or shardIndex < 0 or shardIndex >= shardCount:
+        raise ValueError('Shard index must be between 0 and the shard count minus 1: {0}'.format(shard))
+    
+    return (shardIndex, shardCount)
+
+# Function: mergeStores
+# Iterate over blocks of (sorted k-mer codes, counts) merged from conservation stores with a
+# streaming k-way merge. Each block holds all k-mers up to the smallest last k-mer of the next block
+# of each store, so no later block repeats a k-mer.
+def mergeStores(storeList, blockSize=MERGE_BLOCK_SIZE):
+    
+    position = [0] * len(storeList)
+    
+    while True:
+        active = [i for i in range(len(storeList)) if position[i] < len(storeList[i][0])]
+        
+        if len(active) == 0:
+            break
+        
+        bound = min([storeList[i][0][min(position[i] + blockSize, len(storeList[i][0])) - 1] for i in active])
+        
+        kmerList = []
+        countList = []
+        
+        for i in active:
+            (kmers, counts) = storeList[i]
+            
+            end = position[i] + int(np.searchsorted(kmers[position[i]:(position[i] + blockSize)], bound, side='right'))
+            
+            kmerList.append(np.asarray(kmers[position[i]:end]))
+            countList.append(np.asarray(counts[position[i]:end], dtype=np.int64))
+            
+            position[i] = end
+        
+        kmerCounter = KmerCounter()
+        
+        for (kmers, counts) in zip(kmerList, countList):
+            kmerCounter.add(kmers, counts)
+        
+        kmerCounter.merge()
+        
+        yield (kmerCounter.kmers, kmerCounter.counts)
+
+# Function: writeScores
+# Write conservation scores (count over number of genomes) of k-mers as CSV rows.
+def writeScores(outFile, kSize, kmers, counts, recordCount):
+    
+    for (kmer, count) in zip(kmercode.decodeKmers(kmers, kSize), counts.tolist()):
+        outFile.write('{0},{1}\n'.format(kmer, count / recordCount))
+
+# Function: mergeMain
+# Merge conservation stores from sharded runs (conservation.py merge). The output is identical to a
+# single run over all genomes.
+def mergeMain(argv):
+    
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(prog='conservation.py merge', description='Merge conservation stores of sharded runs (see --shard).')
+    
+    parser.add_argument('storeFileList', metavar='STORE_FILE', nargs='+',
+                        help='List of conservation stores written with --database.')
+    
+    parser.add_argument('-d', '--database', dest='dbFileName', default=None,
+                        help='Merged conservation store.')
+    
+    parser.add_argument('-o', '--out', dest='outFileName', default=None,
+                        help='Output file name.')
+    
+    parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true',
+                        help='Set verbose output.')
+    
+    parser.add_argument('-V', '--noverbose', dest='verbose', action='store_false',
+                        help='Unset verbose output (default).')
+    
+    args = parser.parse_args(argv)
+    verbose = args.verbose
+    
+    if args.outFileName is None and args.dbFileName is None:
+        err('An output file (--out) or conservation store (--database) must be specified', ERR_USAGE)
+    
+    # Open stores
+    storeList = []
+    kSize = None
+    recordCount = 0
+    
+    for storeFileName in args.storeFileList:
+        
+        if verbose:
+            print('Reading conservation store: ' + storeFileName)
+        
+        try:
+            (storeKSize, storeRecordCount, kmers, counts) = kmercode.readConsStore(storeFileName)
+        
+        except IOError as ex:
+            err('Error reading conservation store "{0}": {1}'.format(storeFileName, ex.strerror), ERR_IO)
+        
+        except ValueError as ex:
+            err('Error reading conservation store "{0}": {1}'.format(storeFileName, ex), ERR_USAGE)
+        
+        if kSize is not None and storeKSize != kSize:
+            err('K-mer size of conservation store "{0}" does not match: {1} != {2}'.format(storeFileName, storeKSize, kSize), ERR_USAGE)
+        
+        kSize = storeKSize
+        recordCount += storeRecordCount
+        
+        storeList.append((kmers, counts))
+    
+    # Write merged store (the number of k-mers is counted in a first pass)
+    if args.dbFileName is not None:
+        
+        if verbose:
+            print('Writing conservation store: ' + args.dbFileName)
+        
+        count = sum([len(kmers) for (kmers, counts) in mergeStores(storeList)])
+        
+        tempFileName = args.dbFileName + '.tmp'
+        
+        with open(tempFileName, 'wb') as outFile:
+            outFile.write(struct.pack(kmercode.CONS_HEADER_FORMAT, kmercode.CONS_MAGIC, kmercode.CONS_VERSION, kSize, count, recordCount).ljust(kmercode.CONS_HEADER_SIZE, b'\0'))
+            
+            for (kmers, counts) in mergeStores(storeList):
+                outFile.write(kmers.astype(np.uint64).tobytes())
+            
+            for (kmers, counts) in mergeStores(storeList):
+                outFile.write(counts.astype(np.uint32).tobytes())
+        
+        os.replace(tempFileName, args.dbFileName)
+    
+    # Write reference conservation
+    if args.outFileName is not None:
+        
+        if verbose:
+            print('Opening output file: ' + args.outFileName)
+        
+        outFile = open(args.outFileName, 'w')
+        
+        outFile.write('#kmer,score\n')
+        
+        for (kmers, counts) in mergeStores(storeList):
+            writeScores(outFile, kSize, kmers, counts, recordCount)
+        
+        if verbose:
+            print('Closing output file')
+        
+        outFile.close()
+
+# Class: TargetIndex (target k-mers matched within a number of mismatches)
+# A genome k-mer matches a target k-mer with at most mismatch mismatched bases. Without
+# mismatches, k-mers are looked up directly. Otherwise, a pigeonhole spaced-seed index is used: k-mers
+# are split into mismatch + 2 segments, so a match shares at least two segments exactly, and each
+# pair of segments is a seed. Target k-mers are sorted by the bits of each seed once, and genome
+# k-mers sharing the seed bits of a target are verified by Hamming distance.
+class TargetIndex:
+    
+    def __init__(self, kmers, kSize, mismatch=0):
+        self.kmers = kmers
+        self.kSize = kSize
+        self.mismatch = mismatch
+        
+        self.__seedList = []
+        
+        if mismatch == 0:
+            return
+        
+        # Get a mask of the bits of each segment (bases [start, end))
+        bounds = np.linspace(0, kSize, mismatch + 3).round().astype(int)
+        segmentMaskList = [((1 << (2 * (kSize - start))) - (1 << (2 * (kSize - end)))) for (start, end) in zip(bounds[:-1], bounds[1:])]
+        
+        # Sort targets by seed
+        for (first, second) in itertools.combinations(segmentMaskList, 2):
+            mask = np.uint64(first | second)
+            order = np.argsort(kmers & mask, kind='stable')
+            
+            self.__seedList.append((mask, (kmers & mask)[order], order))
+    
+    # Get the sorted target k-mers matched by any of a set of k-mers.
+    def match(self, kmers):
+        
+        if self.mismatch == 0:
+            return kmers[kmercode.inSorted(self.kmers, kmers)]
+        
+        covered = np.zeros(len(self.kmers), dtype=bool)
+        
+        for (mask, seedKeys, order) in self.__seedList:
+            for start in range(0, len(kmers), MATCH_BLOCK_SIZE):
+                blockKmers = kmers[start:(start + MATCH_BLOCK_SIZE)]
+                
+                # Get candidate (genome k-mer, target k-mer) pairs sharing the seed
+                keys = blockKmers & mask
+                
+                low = np.searchsorted(seedKeys, keys, side='left')
+                candidateCount = np.searchsorted(seedKeys, keys, side='right') - low
+                
+                genomeIndex = np.repeat(np.arange(len(blockKmers)), candidateCount)
+                
+                if len(genomeIndex) == 0:
+                    continue
+                
+                firstCandidate = np.repeat(np.cumsum(candidateCount) - candidateCount, candidateCount)
+                targetIndex = order[np.repeat(low, candidateCount) + np.arange(len(genomeIndex)) - firstCandidate]
+                
+                # Verify
+                isMatch = kmercode.mismatchCount(blockKmers[genomeIndex], self.kmers[targetIndex]) <= self.mismatch
+                covered[targetIndex[isMatch]] = True
+        
+        return self.kmers[covered]
+
+# Class: CountMinSketch (approximate number of genomes each k-mer occurs in)
+# A Count-Min sketch of depth rows of width counters. Each row hashes a k-mer to one counter, and
+# the estimate of a k-mer is its smallest counter, so estimates are never below the true count.
+# Memory is fixed by the width and depth regardless of the number of k-mers counted. The sketch is
+# written as a conservation source that kmercode.ConsScores queries for any k-mer.
+class CountMinSketch:
+    
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        
+        self.table = np.zeros(width * depth, dtype=np.uint32)
+        self.total = 0
+    
+    # Get the counters incremented by adding distinct k-mers of a genome.
+    def cells(self, kmers):
+        
+        return kmercode.sketchCells(kmers, self.width, self.depth).ravel()
+    
+    # Add distinct k-mers of a genome.
+    def add(self, kmers):
+        
+        (cells, counts) = np.unique(self.cells(kmers), return_counts=True)
+        
+        self.addCells(cells, counts)
+    
+    # Add counts to counters (see cells). Cells must be distinct.
+    def addCells(self, cells, counts):
+        
+        self.table[cells] += np.asarray(counts, dtype=np.uint32)
+        self.total += int(np.sum(counts, dtype=np.int64)) // self.depth
+    
+    # Get the estimated count of each k-mer.
+    def estimate(self, kmers):
+        
+        if len(kmers) == 0:
+            return np.zeros(0, dtype=np.int64)
+        
+        return self.table[kmercode.sketchCells(kmers, self.width, self.depth)].min(axis=1).astype(np.int64)
+    
+    # Get (error, probability): estimates exceed true counts by at most error with the probability.
+    def errorBound(self):
+        
+        return (math.e / self.width * self.total, 1 - math.exp(-self.depth))
+
+# Class: KmerCounter (number of records each k-mer occurs in)
+class KmerCounter:
+    
+    def __init__(self):
+        self.kmers = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        
+        self.__pending = []
+        self.__pendingSize = 0
+    
+    # Add distinct k-mers of a record, or sorted k-mers with counts from another counter. K-mers
+    # are buffered and merged in bulk.
+    def add(self, kmers, counts=None):
+        
+        if counts is None:
+            counts = np.ones(len(kmers), dtype=np.int64)
+        
+        self.__pending.append((np.asarray(kmers, dtype=np.uint64), np.asarray(counts, dtype=np.int64)))
+        self.__pendingSize += len(kmers)
+        
+        if self.__pendingSize >= MERGE_SIZE:
+            self.merge()
+    
+    # Merge buffered k-mers into the sorted k-mer and count arrays.
+    def merge(self):
+        
+        if len(self.__pending) == 0:
+            return
+        
+        kmers = np.concatenate([self.kmers] + [pending[0] for pending in self.__pending])
+        counts = np.concatenate([self.counts] + [pending[1] for pending in self.__pending])
+        
+        self.__pending = []
+        self.__pendingSize = 0
+        
+        order = np.argsort(kmers, kind='stable')
+        kmers = kmers[order]
+        counts = counts[order]
+        
+        start = np.flatnonzero(np.concatenate(([len(kmers) > 0], kmers[1:] != kmers[:-1])))
+        
+        self.kmers = kmers[start]
+        self.counts = np.add.reduceat(counts, start) if len(start) > 0 else counts
+
+# Class: PresenceMatrix (packed presence rows of sorted k-mer codes, one genome column at a time)
+class PresenceMatrix:
+    
+    # Start with the rows of an existing matrix (kmers, bits) filling the first recordCount
+    # columns (all zero without a matrix).
+    def __init__(self, recordCount=0, kmers=None, bits=None):
+        
+        if kmers is None:
+            kmers = np.zeros(0, dtype=np.uint64)
+            bits = np.zeros((0, kmercode.presenceRowSize(recordCount)), dtype=np.uint8)
+        
+        self.recordCount = recordCount
+        self.kmers = kmers
+        self.bits = bits
+        
+        self.__pending = []
+        self.__pendingSize = 0
+    
+    # Add the packed presence rows of a batch (see countBatch) as the next count columns. Batches
+    # are buffered and merged in bulk.
+    def add(self, kmers, bits, count):
+        
+        self.__pending.append((self.recordCount, kmers, bits, count))
+        self.__pendingSize += len(kmers)
+        
+        self.recordCount += count
+        
+        if self.__pendingSize >= MERGE_SIZE:
+            self.merge()
+    
+    # Merge buffered batches into the sorted k-mer and presence row arrays.
+    def merge(self):
+        
+        if len(self.__pending) == 0:
+            return
+        
+        kmers = np.unique(np.concatenate([self.kmers] + [pending[1] for pending in self.__pending]))
+        bits = np.zeros((len(kmers), kmercode.presenceRowSize(self.recordCount)), dtype=np.uint8)
+        
+        bits[np.searchsorted(kmers, self.kmers), :self.bits.shape[1]] = self.bits
+        
+        for (genome, batchKmers, batchBits, count) in self.__pending:
+            rows = np.searchsorted(kmers, batchKmers)
+            columns = np.unpackbits(batchBits, axis=1, count=count)
+            
+            for column in range(count):
+                bits[rows[columns[:, column] != 0], (genome + column) >> 3] |= np.uint8(0x80 >> ((genome + column) & 7))
+        
+        self.__pending = []
+        self.__pendingSize = 0
+        
+        self.kmers = kmers
+        self.bits = bits
+
 # Main
 if (__name__ == '__main__'):
     
+    # Merge shards
+    if len(sys.argv) > 1 and sys.argv[1] == 'merge':
+        mergeMain(sys.argv[2:])
+        sys.exit(ERR_NONE)
+    
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Find k-mer-wise conservation by reference.')
     
     parser.add_argument('inFileList', metavar='INPUT_FILE', nargs='+',
                         help='List of input files.')
     
+    parser.add_argument('-a', '--append', dest='append', default=False, action='store_true',
+                        help='Add counts of the input genomes to an existing conservation store (see --database).')
+    
+    parser.add_argument('-c', '--checkpoint', dest='checkpointFileName', default=None,
+                        help='Periodically save counts and the position of the last genome counted to this file so '
+                             'an interrupted run can be resumed (see --resume). The file is removed when the run completes.')
+    
+    parser.add_argument('-d', '--database', dest='dbFileName', default=None,
+                        help='Conservation store with the raw number of genomes each k-mer occurs in. The store is '
+                             'written after counting, and with --append, its counts are extended instead of recomputed. '
+                             'With --sketch, the sketch is written instead.')
+    
     parser.add_argument('-e', '--kanloc', dest='kanalyze', default='kanalyze',
                         help='Location of KAnalyze. "count" and "stream" should be found in this directory.')
     
     parser.add_argument('-f', '--format', dest='format', default='fasta',
                         help='Format of the input file (default = fasta).')
     
+    parser.add_argument('-g', '--shard', dest='shard', default='0/1',
+                        help='Count only genome shard INDEX/COUNT (every COUNT-th genome starting at INDEX, from 0) for a '
+                             'multi-node run. Write a conservation store (--database) and combine the shards with '
+                             '"conservation.py merge".')
+    
+    parser.add_argument('-i', '--interval', dest='checkpointInterval', default=1000,
+                        help='Number of genomes counted between checkpoints (default = 1000).')
+    
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1,
+                        help='Number of processes counting k-mers (default = 1).')
+    
     parser.add_argument('-k', '--ksize', dest='kSize', default=21,
                         help='Size of output k-mers.')
     
@@ -40,18 +732,52 @@ if (__name__ == '__main__'):
     parser.add_argument('-M', '--nomulti', dest='multiSeq', action='store_false',
                         help='Count input sequences from individual files.')
     
-    parser.add_argument('-o', '--out', dest='outFileName', required=True,
+    parser.add_argument('-n', '--native', dest='native', default=False, action='store_true',
+                        help='Count k-mers in-process instead of running KAnalyze "count".')
+    
+    parser.add_argument('-N', '--nonative', dest='native', action='store_false',
+                        help='Count k-mers with KAnalyze "count" (default).')
+    
+    parser.add_argument('-o', '--out', dest='outFileName', default=None,
                         help='Output file name.')
     
+    parser.add_argument('-p', '--presence', dest='presenceFileName', default=None,
+                        help='Write a presence matrix with a bit for each k-mer and genome it occurs in. With --append, '
+                             'the matrix must have been written with the conservation store and is extended.')
+    
+    parser.add_argument('-r', '--target', dest='targetFileName', default=None,
+                        help='Count only k-mers of this reference sequence file and their reverse complements. '
+                             'Other k-mers are not stored, which caps memory on large collections. When appending, '
+                             'use the same target the conservation store was built with.')
+    
+    parser.add_argument('-s', '--sketch', dest='sketch', default=False, action='store_true',
+                        help='Count k-mers approximately in a Count-Min sketch of fixed size, for collections too large to count '
+                             'exactly. The sketch is written to --database and can be queried for any k-mer by tester.py and '
+                             'parser.py. --out requires --target and reports target k-mers. Scores may be overestimated; the '
+                             'error bound is written to the output header.')
+    
     parser.add_argument('-t', '--tempdir', dest='tempDirName', default='temp',
                         help='Location of temporary files.')
     
+    parser.add_argument('-u', '--resume', dest='resume', default=False, action='store_true',
+                        help='Resume from the checkpoint (see --checkpoint) if it exists. Use the same input files and options.')
+    
     parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true',
                         help='Set verbose output.')
     
     parser.add_argument('-V', '--noverbose', dest='verbose', action='store_false',
                         help='Unset verbose output (default).')
     
+    parser.add_argument('-w', '--width', dest='sketchWidth', default=1 << 22,
+                        help='Number of counters in each row of the sketch (default = 4194304).')
+    
+    parser.add_argument('-x', '--mismatch', dest='mismatch', default=0,
+                        help='Count a genome for a target k-mer if it has a k-mer with at most this many mismatched bases '
+                             '(default = 0, usually 1 or 2). Requires --target.')
+    
+    parser.add_argument('-y', '--depth', dest='sketchDepth', default=4,
+                        help='Number of rows of the sketch (default = 4).')
+    
     args = parser.parse_args()
     verbose = args.verbose
     
@@ -63,83 +789,263 @@ if (__name__ == '__main__'):
     if verbose:
         print('Getting k-mer frequencies')
     
-    kmerFrequency = {}
+    try:
+        kSize = kmercode.checkKSize(args.kSize)
+    
+    except ValueError as ex:
+        err(str(ex), ERR_USAGE)
+    
+    jobs = int(args.jobs)
+    kmerCounter = KmerCounter()
+    
+    presence = None
+    presenceKmers = None
+    presenceBits = None
+    
+    targetIndex = None
+    mismatch = int(args.mismatch)
     
-    for file in args.inFileList:
+    sketch = None
+    
+    skipCount = 0
+    resumePosition = (-1, -1, -1)
+    checkpointInterval = int(args.checkpointInterval)
+    
+    try:
+        shard = parseShard(args.shard)
+    
+    except ValueError as ex:
+        err(str(ex), ERR_USAGE)
+    
+    if shard[1] > 1 and args.presenceFileName is not None:
+        err('A presence matrix (--presence) cannot be written with --shard (shards are merged without presence matrices)', ERR_USAGE)
+    
+    if mismatch < 0 or mismatch + 2 > kSize:
+        err('Number of mismatches must be between 0 and {0}: {1}'.format(kSize - 2, mismatch), ERR_USAGE)
+    
+    if args.sketch:
+        
+        if args.outFileName is not None and args.targetFileName is None:
+            err('A target sequence (--target) must be specified to write scores (--out) from a sketch', ERR_USAGE)
+        
+        if mismatch > 0 or args.presenceFileName is not None or args.append or shard[1] > 1:
+            err('A sketch cannot be used with --mismatch, --presence, --append or --shard', ERR_USAGE)
+        
+        sketch = CountMinSketch(int(args.sketchWidth), int(args.sketchDepth))
+    
+    if args.outFileName is None and args.dbFileName is None:
+        err('An output file (--out) or conservation store (--database) must be specified', ERR_USAGE)
+    
+    # Read target k-mers
+    if args.targetFileName is not None:
         
         if verbose:
-            print('Opening sequence file: ' + file)
+            print('Reading target sequence: ' + args.targetFileName)
         
-        if args.multiSeq:
+        try:
+            targetIndex = TargetIndex(targetKmers(args.targetFileName, args.format, kSize), kSize, mismatch)
+        
+        except IOError as ex:
+            err('Error reading target sequence "{0}": {1}'.format(args.targetFileName, ex.strerror), ERR_IO)
+    
+    elif mismatch > 0:
+        err('A target sequence (--target) must be specified to count k-mers with mismatches', ERR_USAGE)
+    
+    # Resume from a checkpoint
+    if args.checkpointFileName is not None:
+        
+        if args.presenceFileName is not None or sketch is not None:
+            err('A checkpoint cannot be used with --presence or --sketch', ERR_USAGE)
+        
+        if args.resume and os.path.exists(args.checkpointFileName):
             
-            inFile = open(file)
+            if verbose:
+                print('Resuming from checkpoint: ' + args.checkpointFileName)
+            
+            try:
+                (checkpointKSize, recordCount, skipCount, resumePosition, checkpointKmers, checkpointCounts) = readCheckpoint(args.checkpointFileName)
             
-            for (index, record) in enumerate(SeqIO.parse(inFile, args.format)):
-                recordCount += 1
+            except IOError as ex:
+                err('Error reading checkpoint "{0}": {1}'.format(args.checkpointFileName, ex.strerror), ERR_IO)
+            
+            except ValueError as ex:
+                err('Error reading checkpoint "{0}": {1}'.format(args.checkpointFileName, ex), ERR_USAGE)
+            
+            if checkpointKSize != kSize:
+                err('K-mer size of checkpoint "{0}" does not match: {1} != {2}'.format(args.checkpointFileName, checkpointKSize, kSize), ERR_USAGE)
+            
+            kmerCounter.add(checkpointKmers, checkpointCounts)
+        
+        elif args.resume:
+            errMsg('Warning: No checkpoint to resume from: ' + args.checkpointFileName)
+    
+    elif args.resume:
+        err('A checkpoint (--checkpoint) must be specified to resume', ERR_USAGE)
+    
+    # Start from existing counts (already included when resuming)
+    if args.append and args.dbFileName is None:
+        err('A conservation store (--database) must be specified to append', ERR_USAGE)
+    
+    if args.append and resumePosition == (-1, -1, -1):
+        
+        if os.path.exists(args.dbFileName):
+            
+            if verbose:
+                print('Reading conservation store: ' + args.dbFileName)
+            
+            try:
+                (dbKSize, recordCount, dbKmers, dbCounts) = kmercode.readConsStore(args.dbFileName)
+            
+            except IOError as ex:
+                err('Error reading conservation store "{0}": {1}'.format(args.dbFileName, ex.strerror), ERR_IO)
+            
+            except ValueError as ex:
+                err('Error reading conservation store "{0}": {1}'.format(args.dbFileName, ex), ERR_USAGE)
+            
+            if dbKSize != kSize:
+                err('K-mer size of conservation store "{0}" does not match: {1} != {2}'.format(args.dbFileName, dbKSize, kSize), ERR_USAGE)
+            
+            kmerCounter.add(dbKmers, dbCounts)
+            
+            if args.presenceFileName is not None:
                 
                 if verbose:
-                    print('Processing read: ' + str(recordCount))
+                    print('Reading presence matrix: ' + args.presenceFileName)
                 
-                kanProc = subprocess.Popen([args.kanalyze + '/count', '-k', str(args.kSize), '-t', tempDirName, '--stdout', '--input', str(record.seq)], stdout=subprocess.PIPE)
+                try:
+                    (presenceKSize, presenceCount, presenceKmers, presenceBits) = kmercode.readPresence(args.presenceFileName)
                 
-                for line in kanProc.stdout:
-                    line = line.decode().strip()
-                    kmer = line.split('\t')[0]
+                except IOError as ex:
+                    err('Error reading presence matrix "{0}": {1}'.format(args.presenceFileName, ex.strerror), ERR_IO)
                 
-                    if kmer in kmerFrequency:
-                        kmerFrequency[kmer] += 1
-                    else:
-                        kmerFrequency[kmer] = 1
-            
-                kanProc.wait()
+                except ValueError as ex:
+                    err('Error reading presence matrix "{0}": {1}'.format(args.presenceFileName, ex), ERR_USAGE)
+                
+                if presenceKSize != kSize or presenceCount != recordCount or len(presenceKmers) != len(dbKmers):
+                    err('Presence matrix "{0}" does not match conservation store "{1}"'.format(args.presenceFileName, args.dbFileName), ERR_USAGE)
+    
+    # Count genomes
+    if args.presenceFileName is not None:
+        presence = PresenceMatrix(recordCount, presenceKmers, presenceBits)
+    
+    if jobs <= 1:
+        pool = None
+        
+        initJob(args, kSize, targetIndex, sketch)
+        batchResults = map(countBatch, batchGenomes(streamGenomes(args, resumePosition, shard), 1))
+    
+    else:
+        pool = multiprocessing.get_context('fork').Pool(jobs, initJob, (args, kSize, targetIndex, sketch))
+        batchResults = pool.imap(countBatch, batchGenomes(streamGenomes(args, resumePosition, shard), BATCH_SIZE))
+    
+    checkpointCount = 0
+    
+    for (kmers, counts, batchCount, bits, position, batchSkipCount) in batchResults:
+        recordCount += batchCount
+        skipCount += batchSkipCount
+        checkpointCount += batchCount + batchSkipCount
+        
+        if verbose:
+            print('Processed reads: ' + str(recordCount))
+        
+        if sketch is not None:
+            sketch.addCells(kmers, counts)
         
-                if (kanProc.returncode != 0):
-                    err('KAnalyze input kmer process died with return code {0}'.format(kanProc.returncode), kanProc.returncode)
-            
-            inFile.close()
-            
         else:
-            recordCount += 1
+            kmerCounter.add(kmers, counts)
             
-            kanProc = subprocess.Popen([args.kanalyze + '/count', '-k', str(args.kSize), '-t', tempDirName, '-f', args.format, '--stdout', file], stdout=subprocess.PIPE)
+            if presence is not None:
+                presence.add(kmers, bits, batchCount)
         
-            for line in kanProc.stdout:
-                line = line.decode().strip()
-                kmer = line.split('\t')[0]
+        # Checkpoint
+        if args.checkpointFileName is not None and checkpointCount >= checkpointInterval:
             
-                if kmer in kmerFrequency:
-                    kmerFrequency[kmer] += 1
-                else:
-                    kmerFrequency[kmer] = 1
-        
-            kanProc.wait()
+            if verbose:
+                print('Writing checkpoint: ' + args.checkpointFileName)
+            
+            kmerCounter.merge()
+            writeCheckpoint(args.checkpointFileName, kSize, recordCount, skipCount, position, kmerCounter.kmers, kmerCounter.counts)
+            
+            checkpointCount = 0
     
-            if (kanProc.returncode != 0):
-                err('KAnalyze input kmer process died with return code {0}'.format(kanProc.returncode), kanProc.returncode)
+    if pool is not None:
+        pool.close()
+        pool.join()
     
-    # Write reference conservation
-    if verbose:
-        print('Opening output file: ' + args.outFileName)
+    if skipCount > 0:
+        errMsg('Warning: Skipped {0} record(s) that could not be counted'.format(skipCount))
     
-    outFile = open(args.outFileName, 'w')
+    kmerCounter.merge()
     
-    outFile.write('#kmer,score\n')
+    # Get estimated counts of target k-mers (capped at the number of genomes)
+    if sketch is not None and targetIndex is not None:
+        estimates = sketch.estimate(targetIndex.kmers)
+        
+        kmerCounter.kmers = targetIndex.kmers[estimates > 0]
+        kmerCounter.counts = np.minimum(estimates[estimates > 0], recordCount)
     
-    for kmer in kmerFrequency:
-        outFile.write('{0},{1}\n'.format(kmer, kmerFrequency[kmer] / recordCount))
+    # Write conservation sketch
+    if args.dbFileName is not None and sketch is not None:
+        
+        if verbose:
+            print('Writing conservation sketch: ' + args.dbFileName)
+        
+        kmercode.writeSketch(args.dbFileName, kSize, recordCount, sketch.total, sketch.width, sketch.depth, sketch.table)
     
-    if verbose:
-        print('Closing output file')
+    # Write conservation store
+    elif args.dbFileName is not None:
+        
+        if verbose:
+            print('Writing conservation store: ' + args.dbFileName)
+        
+        kmercode.writeConsStore(args.dbFileName, kSize, recordCount, kmerCounter.kmers, kmerCounter.counts)
+    
+    # Write presence matrix
+    if args.presenceFileName is not None:
+        
+        if verbose:
+            print('Writing presence matrix: ' + args.presenceFileName)
+        
+        presence.merge()
+        
+        kmercode.writePresence(args.presenceFileName, kSize, recordCount, presence.kmers, presence.bits)
+    
+    # Write reference conservation
+    if args.outFileName is not None:
+        
+        if verbose:
+            print('Opening output file: ' + args.outFileName)
+        
+        outFile = open(args.outFileName, 'w')
+        
+        outFile.write('#kmer,score\n')
+        
+        if sketch is not None:
+            (error, probability) = sketch.errorBound()
+            outFile.write('#sketch width={0} depth={1}: scores exceed exact scores by at most {2} with probability {3}\n'.format(sketch.width, sketch.depth, error / max(recordCount, 1), probability))
+        
+        writeScores(outFile, kSize, kmerCounter.kmers, kmerCounter.counts, recordCount)
+        
+        if verbose:
+            print('Closing output file')
+        
+        outFile.close()
     
-    outFile.close()
+    # Remove checkpoint (the run is complete)
+    if args.checkpointFileName is not None and os.path.exists(args.checkpointFileName):
+        os.remove(args.checkpointFileName)
     
     # Remove temporary directory (fails if it contains files, which it will if k-analyze or removing the temporary file fails)
-    if (verbose):
-        print('Removing temporary directory: ' + tempDirName)
+    if pool is None:
+        endJob()
     
-    try:
-        os.rmdir(tempDirName)
+    if not args.native:
+        if (verbose):
+            print('Removing temporary directory: ' + tempDirName)
         
-    except:
-        errMsg('Warning: Error removing temporary directory: ' + tempDirName + ': ' + sys.exc_info()[0])
+        try:
+            os.rmdir(tempDirName)
+            
+        except:
+            errMsg('Warning: Error removing temporary directory: ' + tempDirName + ': ' + str(sys.exc_info()[1]))
     
\ No newline at end of file
@@ -6,16 +6,31 @@ import sys
 import re
 import csv
 import operator
-from collections import defaultdict
+
+import kmercode
 
 #Constants
 ERR_NONE = 0
 ERR_USAGE = 1
 ERR_IO = 2
 
+#Annotation columns counted in the pair score (present in the tester.py output)
+SCORE_COLUMNS = ['No GC Clamp', 'No 3x Dinucleotide Repeats', 'No 4x Hompolymer Repeats', 'Not Self-Complementary', 'GC 40-60%']
+
 #Open input file
 #inFile = open(args.inFileName, 'r')
 
+#Function: tmPass
+#Check the Tm of the forward and reverse primers of a pair against the Tm options (NaN never passes).
+def tmPass(fwdTm, revTm):
+	if args.minTm is not None and not (fwdTm >= args.minTm and revTm >= args.minTm):
+		return False
+	if args.maxTm is not None and not (fwdTm <= args.maxTm and revTm <= args.maxTm):
+		return False
+	if args.tmDiff is not None and not abs(fwdTm - revTm) <= args.tmDiff:
+		return False
+	return True
+
 
 
 #Main 
@@ -36,6 +51,18 @@ if (__name__ == '__main__'):
 	parser.add_argument('-c', '--conservation', dest='consFileName', required=True, 
 						help='Conservation reference file') 
 	
+	parser.add_argument('-p', '--presence', dest='presenceFileName', default=None, 
+						help='Presence matrix written by conservation.py. Adds the fraction of genomes containing both primers.') 
+	
+	parser.add_argument('-m', '--mintm', dest='minTm', default=None, type=float, 
+						help='Minimum Tm of both primers of a pair.') 
+	
+	parser.add_argument('-x', '--maxtm', dest='maxTm', default=None, type=float, 
+						help='Maximum Tm of both primers of a pair.') 
+	
+	parser.add_argument('-d', '--tmdiff', dest='tmDiff', default=None, type=float, 
+						help='Maximum Tm difference between the primers of a pair.') 
+	
 	parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true',
 						help='Set verbose output.')
 	
@@ -53,49 +80,79 @@ x = []
 row_index=0
 f= open(args.outFileName, 'wt')
 
-#Conservation
-consFile = open(args.consFileName, 'rt')
-
-        #Write header line
-        #outFile.write('Kmer,Rev,Score')
+#Conservation (text file or conservation store, looked up by binary search over sorted k-mer codes)
+try:
+        consScores = kmercode.ConsScores(args.consFileName)
+except (IOError, ValueError) as ex:
+        print('{0}: Error reading conservation file "{1}": {2}'.format(sys.argv[0], args.consFileName, ex), file=sys.stderr)
+        sys.exit(ERR_IO)
 
-#Create Dictionary
-a = defaultdict(float)
 
-for line in consFile:
-        tok = line.strip().split(',')
-        if not line.find("#"):
-            continue
-        if len(tok)<2:
-            continue
-        a[tok[0]] = float(tok[1])
 
+#Scores from a sketch are upper bounds
+consTitle = 'Conservation'
+if consScores.isEstimate:
+        print('{0}: Warning: {1}'.format(sys.argv[0], consScores.estimateNote()), file=sys.stderr)
+        consTitle = 'Conservation Upper Bound'
 
-
-print("Forward Kmer, Fwd Index, Reverse Kmer, Rev Index, Cumulative Score, Fwd Conservation, Rev Conservation", file=f)
+if args.presenceFileName is None:
+        print("Forward Kmer, Fwd Index, Reverse Kmer, Rev Index, Cumulative Score, Fwd {0}, Rev {0}".format(consTitle), file=f)
+else:
+        print("Forward Kmer, Fwd Index, Reverse Kmer, Rev Index, Cumulative Score, Fwd {0}, Rev {0}, Pair Conservation".format(consTitle), file=f)
 with open(args.inFileName, 'rt') as csvfile:
 	samplereader = csv.reader(csvfile, delimiter =',', quotechar=' ')
 	for row in samplereader:
               x.append(row)
              
+#Look up conservation of all k-mers at once
+a = consScores.lookupStr([row[0] for row in x[1:]])[1].tolist()
+
+#Pair conservation (genomes containing both k-mers: popcount of the AND of their presence rows)
+if args.presenceFileName is not None:
+        try:
+                (presenceKSize, presenceCount, presenceKmers, presenceBits) = kmercode.readPresence(args.presenceFileName)
+                kmerRows = kmercode.presenceRows(presenceKmers, presenceBits, kmercode.encodeKmers([row[0] for row in x[1:]], presenceKSize))
+        except (IOError, ValueError) as ex:
+                print('{0}: Error reading presence matrix "{1}": {2}'.format(sys.argv[0], args.presenceFileName, ex), file=sys.stderr)
+                sys.exit(ERR_IO)
+        productlength = int(args.productlength)
+        pairCount = kmercode.countRows(kmerRows[:-productlength] & kmerRows[productlength:]) if productlength < len(kmerRows) else []
+
+#Find annotation columns by name
+column = {name: index for (index, name) in enumerate(x[0])}
+
+for name in ['Fwd kmer GC Content', 'Rev kmer GC Content']:
+        if name not in column:
+                print('{0}: Missing column in input file "{1}": {2}'.format(sys.argv[0], args.inFileName, name), file=sys.stderr)
+                sys.exit(ERR_IO)
+
+filterTm = args.minTm is not None or args.maxTm is not None or args.tmDiff is not None
+
+if filterTm and ('Fwd Tm' not in column or 'Rev Tm' not in column):
+        print('{0}: Missing Tm columns in input file "{1}" (run tester.py with --tm)'.format(sys.argv[0], args.inFileName), file=sys.stderr)
+        sys.exit(ERR_IO)
+
+fwdScoreColumns = [column['Fwd ' + name] for name in SCORE_COLUMNS if 'Fwd ' + name in column]
+revScoreColumns = [column['Rev ' + name] for name in SCORE_COLUMNS if 'Rev ' + name in column]
+fwdGC = column['Fwd GC 40-60%'] if 'Fwd GC 40-60%' in column else None
+revGC = column['Rev GC 40-60%'] if 'Rev GC 40-60%' in column else None
+
 for row in x:
         second_row=int(row_index+int(args.productlength))
         if second_row < len(x):
                 score=0
-                if (x[row_index][4] == "T"): score=score+1
-                if (x[row_index][5] == "T"): score=score+1
-                if (x[row_index][6] == "T"): score=score+1
-                if (x[row_index][7] == "T"): score=score+1
-                if (x[row_index][8] == "T"): score=score+1
-                if (x[second_row][11] == "T"): score=score+1
-                if (x[second_row][12] == "T"): score=score+1
-                if (x[second_row][13] == "T"): score=score+1
-                if (x[second_row][14] == "T"): score=score+1
-                if (x[second_row][15] == "T"): score=score+1
+                for index in fwdScoreColumns:
+                        if (x[row_index][index] == "T"): score=score+1
+                for index in revScoreColumns:
+                        if (x[second_row][index] == "T"): score=score+1
                 #if (re.search('(.{7}).*-.*\\1'.format(x[row_index][0], x[second_row][1])) == None): score=score+100
-                if (x[row_index][8] == "T" and x[second_row][15] == "T" and (float(x[row_index][9])-float(x[second_row][16])==0)): score = score+4
-                if row_index !=0:
-                        print(x[row_index][0],x[row_index][2],x[second_row][1],x[second_row][2],score, a[x[row_index][0]], a[x[second_row][0]], sep=", ", file=f)
+                if (fwdGC is not None and revGC is not None and x[row_index][fwdGC] == "T" and x[second_row][revGC] == "T" and (float(x[row_index][column['Fwd kmer GC Content']])-float(x[second_row][column['Rev kmer GC Content']])==0)): score = score+4
+                if row_index !=0 and filterTm and not tmPass(float(x[row_index][column['Fwd Tm']]), float(x[second_row][column['Rev Tm']])):
+                        pass
+                elif row_index !=0 and args.presenceFileName is not None:
+                        print(x[row_index][0],x[row_index][2],x[second_row][1],x[second_row][2],score, a[row_index - 1], a[second_row - 1], pairCount[row_index - 1] / presenceCount, sep=", ", file=f)
+                elif row_index !=0:
+                        print(x[row_index][0],x[row_index][2],x[second_row][1],x[second_row][2],score, a[row_index - 1], a[second_row - 1], sep=", ", file=f)
                         #print(x[row_index][0],",",x[row_index][2],",",x[second_row][1],",",x[second_row][2],",",score, file=f)
                 row_index=(row_index+1)
 
@@ -0,0 +1,425 @@
+#!/usr/bin/python3
+
+# Nearest-neighbour thermodynamics of k-mers.
+#
+# Melting temperatures (Tm) are computed from the nearest-neighbour dH and dS of the k-mer duplex
+# with a monovalent salt correction. dH and dS are summed as integers (tenths of the parameters),
+# so Tm of windows over a sequence (prefix sums) is identical to Tm of each k-mer.
+#
+# Secondary structures (self-dimers, 3' end dimers and hairpins) are scored by the free energy
+# (dG, kcal/mol at 37 C) of their most stable helix: Watson-Crick stacks (SantaLucia 1998 unified
+# parameters) joined by bulges and internal loops of up to MAX_LOOP bases on each strand. Loops are
+# bounded, so each structure is a banded dynamic program over the k x k pairing matrix with a
+# constant number of predecessors per pair. Single k-mers are memoized, and batches of k-mers of
+# the same size are evaluated together with one array operation per pair.
+
+# Imports
+import functools
+import math
+
+import numpy as np
+
+import kmercode
+
+# Constants
+TEMPERATURE = 310.15  # 37 C in K
+GAS_CONSTANT = 1.9872e-3  # kcal / (K mol)
+
+MAX_LOOP = 2  # Unpaired bases on each strand between two pairs of a helix
+MIN_HAIRPIN_LOOP = 3
+
+STRUCT_CACHE_SIZE = 1 << 16  # Number of k-mers with memoized structures
+
+SALT_CONC = 0.05  # Monovalent cation (Na+) concentration (M)
+OLIGO_CONC = 50e-9  # Oligo concentration (M)
+SALT_DS = 0.368  # Entropy salt correction per nearest-neighbour (cal/(K mol))
+
+# Nearest-neighbour stacks (5' -> 3' / 3' -> 5'), dH (kcal/mol) and dS (cal/(K mol))
+NN_PARAM = {
+    'AA': (-7.9, -22.2), 'TT': (-7.9, -22.2),
+    'AT': (-7.2, -20.4),
+    'TA': (-7.2, -21.3),
+    'CA': (-8.5, -22.7), 'TG': (-8.5, -22.7),
+    'GT': (-8.4, -22.4), 'AC': (-8.4, -22.4),
+    'CT': (-7.8, -21.0), 'AG': (-7.8, -21.0),
+    'GA': (-8.2, -22.2), 'TC': (-8.2, -22.2),
+    'CG': (-10.6, -27.2),
+    'GC': (-9.8, -24.4),
+    'GG': (-8.0, -19.9), 'CC': (-8.0, -19.9)
+}
+
+INIT_PARAM = {'G': (0.1, -2.8), 'C': (0.1, -2.8), 'A': (2.3, 4.1), 'T': (2.3, 4.1)}  # Duplex initiation for each terminal pair
+
+TERMINAL_AT_DG = 0.05  # Terminal A-T pair of a hairpin stem
+
+# Loop initiation dG by loop size (SantaLucia and Hicks 2004). Larger loops are extrapolated.
+BULGE_DG = {1: 4.0, 2: 2.9, 3: 3.1, 4: 3.2}
+INTERNAL_DG = {2: 0.5, 3: 1.6, 4: 1.1}
+HAIRPIN_DG = {3: 3.5, 4: 3.5, 5: 3.3, 6: 4.0, 7: 4.2, 8: 4.3, 9: 4.5}
+
+# Function: paramDG
+# Get dG at temperature from a (dH, dS) pair.
+def paramDG(param, temperature=TEMPERATURE):
+    return param[0] - temperature * param[1] / 1000
+
+# Globals
+complDict = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+stackDG = {dinuc: paramDG(param) for (dinuc, param) in NN_PARAM.items()}
+
+# Function: loopDG
+# Get the dG of a loop of size bases from a table of loop sizes. Loops larger than the table are
+# extrapolated with the Jacobson-Stockmayer term.
+def loopDG(table, size):
+
+    if size in table:
+        return table[size]
+
+    maxSize = max(table)
+
+    return table[maxSize] + 2.44 * GAS_CONSTANT * TEMPERATURE * math.log(size / maxSize)
+
+# Function: stepTable
+# Get a table of the dG of extending a helix from a pair over a loop of [left][right] unpaired bases
+# (bulges have one empty side). The stack entry [0][0] is None (see stackDG).
+def stepTable(maxLoop):
+
+    table = [[None] * (maxLoop + 1) for left in range(maxLoop + 1)]
+
+    for left in range(maxLoop + 1):
+        for right in range(maxLoop + 1):
+            if left == 0 and right == 0:
+                continue
+
+            if left == 0 or right == 0:
+                table[left][right] = loopDG(BULGE_DG, left + right)
+            else:
+                table[left][right] = loopDG(INTERNAL_DG, left + right)
+
+    return table
+
+# Globals
+loopStepDG = stepTable(MAX_LOOP)
+
+initDG = {base: paramDG(param) for (base, param) in INIT_PARAM.items()}
+
+# Parameters by base code (see kmercode), invalid bases (and stacks with them) last
+initCodeDG = np.array([initDG[base] for base in 'ACGT'] + [0.0])
+terminalCodeDG = np.array([TERMINAL_AT_DG, 0.0, 0.0, TERMINAL_AT_DG, 0.0])
+
+stackCodeDG = np.full(25, np.inf)
+
+for (dinuc, dG) in stackDG.items():
+    stackCodeDG['ACGT'.index(dinuc[0]) * 5 + 'ACGT'.index(dinuc[1])] = dG
+
+# Tenths of dH and dS by base code and by nearest-neighbour code (see stackCodeDG)
+initCodeDH = np.zeros(5, dtype=np.int64)
+initCodeDS = np.zeros(5, dtype=np.int64)
+
+for (base, param) in INIT_PARAM.items():
+    initCodeDH['ACGT'.index(base)] = round(param[0] * 10)
+    initCodeDS['ACGT'.index(base)] = round(param[1] * 10)
+
+stackCodeDH = np.zeros(25, dtype=np.int64)
+stackCodeDS = np.zeros(25, dtype=np.int64)
+
+for (dinuc, param) in NN_PARAM.items():
+    stackCodeDH['ACGT'.index(dinuc[0]) * 5 + 'ACGT'.index(dinuc[1])] = round(param[0] * 10)
+    stackCodeDS['ACGT'.index(dinuc[0]) * 5 + 'ACGT'.index(dinuc[1])] = round(param[1] * 10)
+
+# Function: terminalDG
+def terminalDG(base):
+    return TERMINAL_AT_DG if base in 'AT' else 0.0
+
+# Function: cleanKmer
+def cleanKmer(kmer):
+    return kmer.upper().replace('U', 'T')
+
+# Function: pairIndex
+# Get a list of the indices of the bases of a k-mer complementary to each base of another k-mer.
+def pairIndex(kmer, otherKmer):
+
+    baseIndex = {base: [] for base in complDict}
+
+    for (j, base) in enumerate(otherKmer):
+        if base in baseIndex:
+            baseIndex[base].append(j)
+
+    return [baseIndex[complDict[base]] if base in complDict else [] for base in kmer]
+
+# Function: dimerDG
+# Get (dG of the most stable duplex, dG of the most stable duplex including the 3' end of kmer) of
+# two k-mers. Both k-mers are read 5' -> 3' and pair antiparallel. Returns 0 if no helix is stable.
+def dimerDG(kmer, otherKmer):
+
+    kSize = len(kmer)
+    otherRev = otherKmer[::-1]
+
+    # helixDG[i][j]: Most stable helix ending with kmer[i] paired to otherRev[j]
+    helixDG = [dict() for i in range(kSize)]
+
+    bestDG = 0.0
+    endDG = 0.0
+
+    for (i, pairList) in enumerate(pairIndex(kmer, otherRev)):
+        pairInit = initDG.get(kmer[i], 0.0)
+        stack = stackDG.get(kmer[(i - 1):(i + 1)]) if i > 0 else None
+
+        for j in pairList:
+            pairDG = pairInit
+
+            for left in range(min(MAX_LOOP + 1, i)):
+                prevHelix = helixDG[i - 1 - left]
+                loopRow = loopStepDG[left]
+
+                for right in range(min(MAX_LOOP + 1, j)):
+                    prevDG = prevHelix.get(j - 1 - right)
+
+                    if prevDG is None:
+                        continue
+
+                    if left == 0 and right == 0:
+                        prevDG += stack
+                    else:
+                        prevDG += loopRow[right]
+
+                    if prevDG < pairDG:
+                        pairDG = prevDG
+
+            helixDG[i][j] = pairDG
+            pairDG += pairInit
+
+            if pairDG < bestDG:
+                bestDG = pairDG
+
+            if i == kSize - 1 and pairDG < endDG:
+                endDG = pairDG
+
+    return (bestDG, endDG)
+
+# Function: hairpinDG
+# Get the dG of the most stable hairpin of a k-mer (a helix of the k-mer with itself closed by a
+# loop of at least MIN_HAIRPIN_LOOP bases). Returns 0 if no hairpin is stable.
+def hairpinDG(kmer):
+
+    kSize = len(kmer)
+
+    # stemDG[i][j]: Most stable stem with kmer[i] paired to kmer[j] as its outer pair
+    stemDG = [dict() for i in range(kSize)]
+
+    bestDG = 0.0
+
+    pairList = pairIndex(kmer, kmer)
+
+    for i in range(kSize - MIN_HAIRPIN_LOOP - 2, -1, -1):
+        pairTerminal = terminalDG(kmer[i])
+        stack = stackDG.get(kmer[i:(i + 2)])
+
+        for j in pairList[i]:
+            if j - i <= MIN_HAIRPIN_LOOP:
+                continue
+
+            pairDG = loopDG(HAIRPIN_DG, j - i - 1) + pairTerminal
+
+            for left in range(MAX_LOOP + 1):
+                nextStem = stemDG[i + 1 + left]
+                loopRow = loopStepDG[left]
+
+                for right in range(MAX_LOOP + 1):
+                    nextJ = j - 1 - right
+
+                    if nextJ - (i + 1 + left) <= MIN_HAIRPIN_LOOP:
+                        break
+
+                    nextDG = nextStem.get(nextJ)
+
+                    if nextDG is None:
+                        continue
+
+                    if left == 0 and right == 0:
+                        nextDG += stack
+                    else:
+                        nextDG += loopRow[right]
+
+                    if nextDG < pairDG:
+                        pairDG = nextDG
+
+            stemDG[i][j] = pairDG
+
+            if pairDG + pairTerminal < bestDG:
+                bestDG = pairDG + pairTerminal
+
+    return bestDG
+
+# Function: kmerStructure
+# Get (self-dimer dG, 3' end dimer dG, hairpin dG) of a k-mer. Results are memoized.
+@functools.lru_cache(maxsize=STRUCT_CACHE_SIZE)
+def kmerStructure(kmer):
+
+    kmer = cleanKmer(kmer)
+
+    (dimer, end) = dimerDG(kmer, kmer)
+
+    return (dimer, end, hairpinDG(kmer))
+
+# Function: dimerDGMatrix
+# Get arrays (dG of the most stable self-dimer, dG of the most stable self-dimer including the 3'
+# end) of a matrix of base codes with one k-mer in each row (see dimerDG).
+def dimerDGMatrix(codes):
+
+    (nKmer, kSize) = codes.shape
+    codes = np.ascontiguousarray(codes.T, dtype=np.int64)
+    otherRev = codes[::-1]
+
+    # helixDG[i][j]: Most stable helix ending with base i paired to otherRev[j] (last rows only)
+    helixDG = dict()
+
+    bestDG = np.zeros(nKmer)
+    endDG = np.zeros(nKmer)
+
+    for i in range(kSize):
+        pairInit = initCodeDG[codes[i]]
+        stack = stackCodeDG[codes[i - 1] * 5 + codes[i]] if i > 0 else None
+        helixRow = np.full((kSize, nKmer), np.inf)
+
+        for j in range(kSize):
+            isPair = (codes[i] + otherRev[j]) == 3
+
+            if not isPair.any():
+                continue
+
+            pairDG = pairInit.copy()
+
+            for left in range(min(MAX_LOOP + 1, i)):
+                prevHelix = helixDG[i - 1 - left]
+
+                for right in range(min(MAX_LOOP + 1, j)):
+                    if left == 0 and right == 0:
+                        np.minimum(pairDG, prevHelix[j - 1] + stack, out=pairDG)
+                    else:
+                        np.minimum(pairDG, prevHelix[j - 1 - right] + loopStepDG[left][right], out=pairDG)
+
+            helixRow[j][isPair] = pairDG[isPair]
+
+        helixDG[i] = helixRow
+        helixDG.pop(i - MAX_LOOP - 1, None)
+
+        pairDG = (helixRow + pairInit).min(axis=0)
+        np.minimum(bestDG, pairDG, out=bestDG)
+
+        if i == kSize - 1:
+            np.minimum(endDG, pairDG, out=endDG)
+
+    return (bestDG, endDG)
+
+# Function: hairpinDGMatrix
+# Get an array of the dG of the most stable hairpin of each k-mer of a matrix of base codes (see
+# hairpinDG).
+def hairpinDGMatrix(codes):
+
+    (nKmer, kSize) = codes.shape
+    codes = np.ascontiguousarray(codes.T, dtype=np.int64)
+
+    # stemDG[i][j]: Most stable stem with base i paired to base j as its outer pair (last rows only)
+    stemDG = dict()
+    noStem = np.full((kSize, nKmer), np.inf)
+
+    bestDG = np.zeros(nKmer)
+
+    for i in range(kSize - MIN_HAIRPIN_LOOP - 2, -1, -1):
+        pairTerminal = terminalCodeDG[codes[i]]
+        stack = stackCodeDG[codes[i] * 5 + codes[i + 1]]
+        stemRow = np.full((kSize, nKmer), np.inf)
+
+        for j in range(i + MIN_HAIRPIN_LOOP + 1, kSize):
+            isPair = (codes[i] + codes[j]) == 3
+
+            if not isPair.any():
+                continue
+
+            pairDG = loopDG(HAIRPIN_DG, j - i - 1) + pairTerminal
+
+            for left in range(MAX_LOOP + 1):
+                nextStem = stemDG.get(i + 1 + left, noStem)
+
+                for right in range(MAX_LOOP + 1):
+                    if (j - 1 - right) - (i + 1 + left) <= MIN_HAIRPIN_LOOP:
+                        break
+
+                    if left == 0 and right == 0:
+                        np.minimum(pairDG, nextStem[j - 1] + stack, out=pairDG)
+                    else:
+                        np.minimum(pairDG, nextStem[j - 1 - right] + loopStepDG[left][right], out=pairDG)
+
+            stemRow[j][isPair] = pairDG[isPair]
+
+        stemDG[i] = stemRow
+        stemDG.pop(i + MAX_LOOP + 1, None)
+
+        np.minimum(bestDG, (stemRow + pairTerminal).min(axis=0), out=bestDG)
+
+    return bestDG
+
+# Function: structureMatrix
+# Get arrays (self-dimer dG, 3' end dimer dG, hairpin dG) of a matrix of characters (uint8) with one
+# k-mer in each row.
+def structureMatrix(kmerMatrix):
+
+    codes = kmercode.baseCode[kmerMatrix]
+
+    (dimer, end) = dimerDGMatrix(codes)
+
+    return (dimer, end, hairpinDGMatrix(codes))
+
+# Function: meltingTemp
+# Get the Tm (C) of k-mers from arrays of their duplex dH and dS (tenths of kcal/mol and
+# cal/(K mol)). Non-self-complementary duplexes at OLIGO_CONC with the salt correction of
+# SantaLucia 1998.
+def meltingTemp(dH, dS, kSize):
+
+    dS = dS / 10 + SALT_DS * (kSize - 1) * np.log(SALT_CONC)
+
+    return 1000 * (dH / 10) / (dS + GAS_CONSTANT * 1000 * np.log(OLIGO_CONC / 4)) - 273.15
+
+# Function: tmMatrix
+# Get an array of the Tm of each k-mer of a matrix of characters (uint8) with one k-mer in each row.
+# K-mers with bases other than A, C, G and T have a Tm of NaN.
+def tmMatrix(kmerMatrix):
+
+    codes = kmercode.baseCode[kmerMatrix].astype(np.int64)
+    stacks = codes[:, :-1] * 5 + codes[:, 1:]
+
+    dH = stackCodeDH[stacks].sum(axis=1) + initCodeDH[codes[:, 0]] + initCodeDH[codes[:, -1]]
+    dS = stackCodeDS[stacks].sum(axis=1) + initCodeDS[codes[:, 0]] + initCodeDS[codes[:, -1]]
+
+    tm = meltingTemp(dH, dS, codes.shape[1])
+    tm[(codes == kmercode.CODE_INVALID).any(axis=1)] = np.nan
+
+    return tm
+
+# Function: tmWindows
+# Get an array of the Tm of each window of size kSize of a sequence of characters (uint8). dH and
+# dS of each window are O(1) prefix sum queries over the nearest-neighbours of the sequence.
+def tmWindows(seq, kSize):
+
+    codes = kmercode.baseCode[seq].astype(np.int64)
+    stacks = codes[:-1] * 5 + codes[1:]
+
+    nWindow = len(codes) - kSize + 1
+
+    sumDH = np.concatenate(([0], np.cumsum(stackCodeDH[stacks])))
+    sumDS = np.concatenate(([0], np.cumsum(stackCodeDS[stacks])))
+    sumInvalid = np.concatenate(([0], np.cumsum(codes == kmercode.CODE_INVALID)))
+
+    dH = sumDH[(kSize - 1):] - sumDH[:nWindow] + initCodeDH[codes[:nWindow]] + initCodeDH[codes[(kSize - 1):]]
+    dS = sumDS[(kSize - 1):] - sumDS[:nWindow] + initCodeDS[codes[:nWindow]] + initCodeDS[codes[(kSize - 1):]]
+
+    tm = meltingTemp(dH, dS, kSize)
+    tm[(sumInvalid[kSize:] - sumInvalid[:nWindow]) > 0] = np.nan
+
+    return tm
+
+# Function: kmerTm
+# Get the Tm of a k-mer.
+def kmerTm(kmer):
+    return float(tmMatrix(np.frombuffer(cleanKmer(kmer).encode(), dtype=np.uint8)[None, :])[0])
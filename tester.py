@@ -2,17 +2,38 @@
 
 # Imports
 import argparse
+import collections
+import hashlib
+import json
+import sqlite3
 import sys
 import re
 
+import numpy as np
+
+import kmercode
+import thermo
+
 # Constants
 ERR_NONE = 0
 ERR_USAGE = 1
 ERR_IO = 2
 
+TABLE_BLOCK_SIZE = 65536  # Number of k-mers decoded at a time from a k-mer table
+ANNO_BATCH_SIZE = 65536  # Number of k-mers annotated at a time
+
+ANNO_CACHE_VERSION = 2  # Change when the results of an annotation change
+ANNO_CACHE_SIZE = 1 << 20  # Number of k-mers in the in-memory annotation cache
+CACHE_QUERY_SIZE = 500  # Number of k-mers looked up in the on-disk cache at a time
+
 # Globals
 revDict = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C'}
 
+complBase = np.arange(256, dtype=np.uint8)
+
+for (base, compl) in revDict.items():
+    complBase[ord(base)] = ord(compl)
+
 # Function: Reverse complement
 def revComplStr(s):
     sr = ''
@@ -23,20 +44,189 @@ def revComplStr(s):
     
     return sr
 
+# Function: revComplList
+# Get the reverse complement of each k-mer of a list. K-mers of the same size with only A, C, G and T
+# are reversed as a matrix.
+def revComplList(kmerList):
+    
+    matrix = kmerMatrix(kmerList)
+    
+    if matrix is None or not isBase(matrix, 'ACGT').all():
+        return [revComplStr(kmer) for kmer in kmerList]
+    
+    revMatrix = np.ascontiguousarray(complBase[matrix][:, ::-1])
+    
+    return revMatrix.view('S{0}'.format(matrix.shape[1])).ravel().astype('U{0}'.format(matrix.shape[1])).tolist()
+
 # Function: err
 def err(msg, ret):
     print("{0}: {1}".format(sys.argv[0], msg))
     sys.exit(ret)
 
+# Function: readKmerRows
+# Iterate over the fields (k-mer, filter, index) of each row of a binary file opened from
+# kfilter.py output. The file is a CSV file or a columnar k-mer table.
+def readKmerRows(inFile):
+    
+    if inFile.read(len(kmercode.TABLE_MAGIC)) == kmercode.TABLE_MAGIC:
+        (kSize, kmers, index, keep) = kmercode.readKmerTable(inFile.name)
+        
+        for i in range(0, len(kmers), TABLE_BLOCK_SIZE):
+            kmerList = kmercode.decodeKmers(kmers[i:(i + TABLE_BLOCK_SIZE)], kSize)
+            filterList = ['1' if filterPass else '0' for filterPass in keep[i:(i + TABLE_BLOCK_SIZE)].tolist()]
+            indexList = [str(position) for position in index[i:(i + TABLE_BLOCK_SIZE)].tolist()]
+            
+            yield from zip(kmerList, filterList, indexList)
+        
+        return
+    
+    inFile.seek(0)
+    
+    for line in inFile:
+        yield line.decode().strip().split(',')
+
+# Function: batchRows
+# Iterate over lists of up to batchSize rows with a k-mer, filter and index.
+def batchRows(rows, batchSize=ANNO_BATCH_SIZE):
+    
+    batch = []
+    
+    for tok in rows:
+        if (len(tok) < 2):
+            continue
+        
+        batch.append(tok)
+        
+        if len(batch) == batchSize:
+            yield batch
+            batch = []
+    
+    if len(batch) > 0:
+        yield batch
+
+# Function: kmerMatrix
+# Get a matrix of the characters (uint8) of a list of k-mers with one k-mer in each row, or None
+# if the k-mers are not all the same size.
+def kmerMatrix(kmerList):
+    
+    if len(kmerList) == 0:
+        return None
+    
+    data = ''.join(kmerList).encode()
+    
+    if len(data) != len(kmerList) * len(kmerList[0]):
+        return None
+    
+    return np.frombuffer(data, dtype=np.uint8).reshape(len(kmerList), len(kmerList[0]))
+
+# Function: isBase
+# Get a boolean matrix of characters of a k-mer matrix found in a string of bases.
+def isBase(matrix, bases):
+    
+    return np.isin(matrix, np.frombuffer(bases.encode(), dtype=np.uint8))
+
+# Function: hasRun
+# Test each row of a boolean matrix for a run of at least size True values.
+def hasRun(matrix, size):
+    
+    if matrix.shape[1] < size:
+        return np.zeros(matrix.shape[0], dtype=bool)
+    
+    count = np.concatenate((np.zeros((matrix.shape[0], 1), dtype=np.int64), np.cumsum(matrix, axis=1)), axis=1)
+    
+    return ((count[:, size:] - count[:, :-size]) == size).any(axis=1)
+
+# Function: getAnnoScore
+# Get (column text, score, pass) from the value returned by AnnoElement.check: a (text, score) or
+# (text, pass) tuple, a pass boolean or a score.
+def getAnnoScore(annoRet):
+    
+    if isinstance(annoRet, tuple):
+        # Returned tuple
+        if isinstance(annoRet[1], bool):
+            return (annoRet[0], 0, annoRet[1])
+        
+        return (annoRet[0], annoRet[1], True)
+    
+    # Returned score or boolean
+    if isinstance(annoRet, bool):
+        return ('T' if annoRet else 'F', 0, annoRet)
+    
+    return (str(annoRet), annoRet, True)
+
+# Function: runStarts
+# Get a boolean array with True at each index of a boolean array where a run of size True values
+# starts.
+def runStarts(flags, size):
+    
+    if len(flags) < size:
+        return np.zeros(0, dtype=bool)
+    
+    count = np.concatenate(([0], np.cumsum(flags)))
+    
+    return (count[size:] - count[:-size]) == size
+
+# Function: windowAny
+# Test each window of size kSize of a sequence for a pattern of size patternSize, given the start
+# flags of the pattern in the sequence (see runStarts). Each window is an O(1) prefix sum query.
+def windowAny(starts, patternSize, kSize, nWindow):
+    
+    if kSize < patternSize:
+        return np.zeros(nWindow, dtype=bool)
+    
+    count = np.concatenate(([0], np.cumsum(starts)))
+    window = np.arange(nWindow)
+    
+    return (count[window + kSize - patternSize + 1] - count[window]) > 0
+
+# Function: windowCount
+# Get the number of True values of a boolean array in each window of size kSize (prefix sums).
+def windowCount(flags, kSize):
+    
+    count = np.concatenate(([0], np.cumsum(flags)))
+    
+    return count[kSize:] - count[:-kSize]
+
+# Function: kmerSegments
+# Iterate over (start, end) row ranges of consecutive k-mers, where each k-mer follows the previous
+# one by one position in the same sequence.
+def kmerSegments(kmerMatrix, posList):
+    
+    positions = np.asarray(posList)
+    
+    follows = (positions[1:] == positions[:-1] + 1) & (kmerMatrix[1:, :-1] == kmerMatrix[:-1, 1:]).all(axis=1)
+    bounds = np.concatenate(([0], np.flatnonzero(~follows) + 1, [len(posList)]))
+    
+    return zip(bounds[:-1].tolist(), bounds[1:].tolist())
+
 # Class: AnnoElement
 class AnnoElement:
     
+    # Results depend only on the k-mer (not its position) and may be cached (see AnnoCache)
+    cacheable = True
+    
     def __init__(self, title, maxScore):
         self.title = title
         self.maxScore = maxScore
     
     def check(self, kmer, pos):
         return True
+    
+    # Get a string identifying the element and its parameters for the annotation cache.
+    def profile(self):
+        return '{0}{1}'.format(type(self).__name__, sorted((name, value) for (name, value) in vars(self).items() if isinstance(value, (bool, int, float, str))))
+    
+    # Check a list of k-mers at once and get a list of check results. kmerMatrix holds the
+    # characters of the k-mers (see kmerMatrix) or is None. Elements that can be evaluated as
+    # array operations override this; the default calls check for each k-mer.
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        return [self.check(kmer, pos) for (kmer, pos) in zip(kmerList, posList)]
+    
+    # Check the k-mers of a contiguous sequence (seq, a uint8 array of characters), where k-mer i
+    # starts at seq[i]. Elements with window queries over the sequence override this; the default
+    # checks the k-mers as a batch.
+    def checkWindows(self, kmerList, posList, seq):
+        return self.checkBatch(kmerList, posList, np.lib.stride_tricks.sliding_window_view(seq, len(seq) - len(kmerList) + 1))
 
 # Class: AnnoEndGC (k-mer does not end with GC)
 class AnnoEndGC(AnnoElement):
@@ -48,6 +238,20 @@ class AnnoEndGC(AnnoElement):
             return True
         
         return False
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None or kmerMatrix.shape[1] < 2:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return (~((kmerMatrix[:, -2] == ord('G')) & (kmerMatrix[:, -1] == ord('C')))).tolist()
+    
+    def checkWindows(self, kmerList, posList, seq):
+        kSize = len(seq) - len(kmerList) + 1
+        
+        if kSize < 2:
+            return AnnoElement.checkWindows(self, kmerList, posList, seq)
+        
+        return (~((seq[(kSize - 2):-1] == ord('G')) & (seq[(kSize - 1):] == ord('C')))).tolist()
 
 # Class: AnnoDinucleotide (k-mer does not contain 3x Dinucleotide Repeat)
 class AnnoDiNuc(AnnoElement):
@@ -56,6 +260,15 @@ class AnnoDiNuc(AnnoElement):
     
     def check(self, kmer, pos):
         return (re.search('(..)\\1\\1', kmer) == None)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return (~hasRun(kmerMatrix[:, 2:] == kmerMatrix[:, :-2], 4)).tolist()
+    
+    def checkWindows(self, kmerList, posList, seq):
+        return (~windowAny(runStarts(seq[2:] == seq[:-2], 4), 6, len(seq) - len(kmerList) + 1, len(kmerList))).tolist()
 
 # Class: AnnoHomopolymer (k-mer does not contain 4x Homopolymer Repeat)
 class AnnoHomoPol(AnnoElement):
@@ -64,6 +277,15 @@ class AnnoHomoPol(AnnoElement):
     
     def check(self, kmer, pos):
         return (re.search('(.)\\1{3}', kmer) == None)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return (~hasRun(kmerMatrix[:, 1:] == kmerMatrix[:, :-1], 3)).tolist()
+    
+    def checkWindows(self, kmerList, posList, seq):
+        return (~windowAny(runStarts(seq[1:] == seq[:-1], 3), 4, len(seq) - len(kmerList) + 1, len(kmerList))).tolist()
 
 # Class: AnnoSelfComplementarity (k-mer is not Self-Complementary)
 class AnnoSelfComp(AnnoElement):
@@ -72,7 +294,89 @@ class AnnoSelfComp(AnnoElement):
     
     def check(self, kmer, pos):
         return (re.search('(...).*-.*\\1', '{0}-{1}'.format(kmer, revComplStr(kmer))) == None)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None or kmerMatrix.shape[1] < 3 or not isBase(kmerMatrix, 'ACGT').all():
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        # A 3-mer of the k-mer is found in its reverse complement
+        codes = kmercode.baseCode[kmerMatrix].astype(np.int64)
+        revCodes = 3 - codes[:, ::-1]
+        
+        triCodes = codes[:, :-2] * 16 + codes[:, 1:-1] * 4 + codes[:, 2:]
+        revTriCodes = revCodes[:, :-2] * 16 + revCodes[:, 1:-1] * 4 + revCodes[:, 2:]
+        
+        hasTri = np.zeros((len(kmerList), 64), dtype=bool)
+        hasTri[np.arange(len(kmerList))[:, None], triCodes] = True
+        
+        return (~hasTri[np.arange(len(kmerList))[:, None], revTriCodes].any(axis=1)).tolist()
 	
+# Class: StructureCache (secondary structures of the k-mers of a batch)
+# Structure annotations share one thermo.structureMatrix result for each k-mer matrix of a batch
+# (forward and reverse k-mers, or each sequence in window mode). Results are kept until the cache is
+# cleared for the next batch.
+class StructureCache:
+    def __init__(self):
+        self.clear()
+    
+    def clear(self):
+        self.__structDict = {}  # id(key) -> (key, structures), the key is held so its id is not reused
+    
+    # Get (self-dimer dG, 3' end dimer dG, hairpin dG) arrays of a k-mer matrix, cached by key (the
+    # matrix or the sequence it was built from).
+    def structures(self, kmerMatrix, key=None):
+        
+        if key is None:
+            key = kmerMatrix
+        
+        if id(key) not in self.__structDict:
+            self.__structDict[id(key)] = (key, thermo.structureMatrix(kmerMatrix))
+        
+        return self.__structDict[id(key)][1]
+
+# Class: AnnoStructure (dG of a secondary structure of the k-mer is above minDG)
+class AnnoStructure(AnnoElement):
+    def __init__(self, title, index, minDG, structCache):
+        AnnoElement.__init__(self, title, 0)
+        
+        self.index = index  # Index of the structure in thermo.kmerStructure
+        self.minDG = minDG
+        self.structCache = structCache
+    
+    def check(self, kmer, pos):
+        structDG = thermo.kmerStructure(kmer)[self.index]
+        
+        return ('{0:.2f}'.format(structDG), structDG > self.minDG)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return self.__results(self.structCache.structures(kmerMatrix))
+    
+    def checkWindows(self, kmerList, posList, seq):
+        windowMatrix = np.lib.stride_tricks.sliding_window_view(seq, len(seq) - len(kmerList) + 1)
+        
+        return self.__results(self.structCache.structures(windowMatrix, seq))
+    
+    def __results(self, structures):
+        return [('{0:.2f}'.format(structDG), structDG > self.minDG) for structDG in structures[self.index].tolist()]
+
+# Class: AnnoSelfDimer (k-mer does not form a stable duplex with itself)
+class AnnoSelfDimer(AnnoStructure):
+    def __init__(self, structCache, minDG=-9.0):
+        AnnoStructure.__init__(self, 'Self-Dimer dG', 0, minDG, structCache)
+
+# Class: AnnoEndDimer (3' end of the k-mer does not form a stable duplex with the k-mer)
+class AnnoEndDimer(AnnoStructure):
+    def __init__(self, structCache, minDG=-5.0):
+        AnnoStructure.__init__(self, '3\' Self-Dimer dG', 1, minDG, structCache)
+
+# Class: AnnoHairpin (k-mer does not form a stable hairpin)
+class AnnoHairpin(AnnoStructure):
+    def __init__(self, structCache, minDG=-3.0):
+        AnnoStructure.__init__(self, 'Hairpin dG', 2, minDG, structCache)
+
 # Class: AnnoReverseKmer (prints reverse kmer)
 class AnnoReverseKmer(AnnoElement):
     def __init__(self):
@@ -92,6 +396,12 @@ class AnnoPos10AU(AnnoElement):
             return 0.05
         
         return 0
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None or kmerMatrix.shape[1] < 10:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return [0.05 if isAU else 0 for isAU in isBase(kmerMatrix[:, 9], 'AU').tolist()]
 
 # Class AnnoPos19 (k-mer has A or U at position 19) 
 class AnnoPos19AU(AnnoElement):
@@ -103,6 +413,12 @@ class AnnoPos19AU(AnnoElement):
             return 0.15
         
         return 0
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None or kmerMatrix.shape[1] < 19:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return [0.15 if isAU else 0 for isAU in isBase(kmerMatrix[:, 18], 'AU').tolist()]
 
 # Class AnnoPos15to20AUx3 (k-mer 3 A or U between positions 15 and 20 inclusive)
 class AnnoPos15to20AUx3(AnnoElement):
@@ -114,6 +430,12 @@ class AnnoPos15to20AUx3(AnnoElement):
             return 0.50
         
         return 0
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return [0.50 if isAU else 0 for isAU in (isBase(kmerMatrix[:, 14:20], 'AU').sum(axis=1) >= 3).tolist()]
 
 # Class AnnoPos17to19AUCount (0.10 for each A/U between positions 17 and 19 inclusive)
 class AnnoPos17to19AUCount(AnnoElement):
@@ -122,6 +444,12 @@ class AnnoPos17to19AUCount(AnnoElement):
     
     def check(self, kmer, pos):
         return (len(re.findall('A|U', kmer[16:19])) * 0.1)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return [count * 0.1 for count in isBase(kmerMatrix[:, 16:19], 'AU').sum(axis=1).tolist()]
 
 # Class AnnoGC40to60 (False for any k-mer without GC content between 40% and 60% inclusive)
 class AnnoGC40to60(AnnoElement):
@@ -135,6 +463,20 @@ class AnnoGC40to60(AnnoElement):
             return True
         
         return False
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        gcContent = isBase(kmerMatrix, 'GC').sum(axis=1) / kmerMatrix.shape[1]
+        
+        return ((gcContent >= 0.40) & (gcContent <= 0.60)).tolist()
+    
+    def checkWindows(self, kmerList, posList, seq):
+        kSize = len(seq) - len(kmerList) + 1
+        gcContent = windowCount(isBase(seq, 'GC'), kSize) / kSize
+        
+        return ((gcContent >= 0.40) & (gcContent <= 0.60)).tolist()
 
 # Class AnnoRestrictionSites (False for any with restriction sites)
 class AnnoRestrictionSites(AnnoElement):
@@ -157,63 +499,70 @@ class Anno7GCRun(AnnoElement):
             return True
         
         return False
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return (~hasRun(isBase(kmerMatrix, 'GC'), 7)).tolist()
+    
+    def checkWindows(self, kmerList, posList, seq):
+        return (~windowAny(runStarts(isBase(seq, 'GC'), 7), 7, len(seq) - len(kmerList) + 1, len(kmerList))).tolist()
 
 class AnnoCons(AnnoElement):
+    
+    cacheable = False  # Lookups are cheap and the conservation file changes between runs
+    
     def __init__(self, consFileName):
         AnnoElement.__init__(self, 'Conservation', 0)
         
-        self.consDict = {}
-        
         self.consFileName = consFileName
-        self.__readConsFile()
+        self.consScores = kmercode.ConsScores(consFileName)
+        
+        # Scores from a sketch are upper bounds
+        if self.consScores.isEstimate:
+            self.title = 'Conservation Upper Bound'
     
     def check(self, kmer, pos):
         
-        if kmer in self.consDict:
-            return (self.consDict[kmer], 0)
+        (found, score) = self.consScores.lookupStr([kmer])
+        
+        if found[0]:
+            return (float(score[0]), 0)
         
         return (0, 0)
     
-    def __readConsFile(self):
-        lineCount = 0
-        
-        consFile = open(self.consFileName, 'r')
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        (found, score) = self.consScores.lookupStr(kmerList)
         
-        for line in consFile:
-            lineCount += 1
-            
-            line = line.strip()
-            
-            # Skip empty lines and comments
-            if (len(line) == 0 or line[0] == '#'):
-                continue
-            
-            tok = line.split(',')
-            kmer = tok[0].upper().replace('T', 'U')
-            conScore = float(tok[1])
-            
-            if conScore < 0 or conScore > 1:
-                raise ValueError('Bad conservation record on line {0} ({1}): Entry must be between 0 and 1: '.format(lineCount, self.consFileName, tok[1]))
-            
-            self.consDict[kmer] = conScore
+        return [(consScore, 0) if isFound else (0, 0) for (isFound, consScore) in zip(found.tolist(), score.tolist())]
 
 class AnnoConsFilter(AnnoElement):
-    def __init__(self, consDict, threshold=0.9):
+    
+    cacheable = False
+    
+    def __init__(self, consScores, threshold=0.9):
         AnnoElement.__init__(self, 'Cons Thresh', 0)
         
-        if consDict is None:
-            consDict = {}
-        
-        self.consDict = consDict
+        self.consScores = consScores
         self.threshold = threshold
     
     def check(self, kmer, pos):
         
-        if kmer in self.consDict:
-            if (self.consDict[kmer] > self.threshold):
-                return True
+        if self.consScores is None:
+            return False
         
-        return False
+        (found, score) = self.consScores.lookupStr([kmer])
+        
+        return bool(found[0] and score[0] > self.threshold)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if self.consScores is None:
+            return [False] * len(kmerList)
+        
+        (found, score) = self.consScores.lookupStr(kmerList)
+        
+        return (found & (score > self.threshold)).tolist()
 
 class GC_Content(AnnoElement):
     def __init__(self):
@@ -227,9 +576,40 @@ class GC_Content(AnnoElement):
         
        # return False
         return(gcContent, 0)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return [(gcContent, 0) for gcContent in (isBase(kmerMatrix, 'GC').sum(axis=1) / kmerMatrix.shape[1]).tolist()]
+    
+    def checkWindows(self, kmerList, posList, seq):
+        kSize = len(seq) - len(kmerList) + 1
+        
+        return [(gcContent, 0) for gcContent in (windowCount(isBase(seq, 'GC'), kSize) / kSize).tolist()]
+
+# Class AnnoTm (Nearest-neighbour melting temperature)
+class AnnoTm(AnnoElement):
+    def __init__(self):
+        AnnoElement.__init__(self, 'Tm', 0)
+    
+    def check(self, kmer, pos):
+        return ('{0:.2f}'.format(thermo.kmerTm(kmer)), True)
+    
+    def checkBatch(self, kmerList, posList, kmerMatrix):
+        if kmerMatrix is None:
+            return AnnoElement.checkBatch(self, kmerList, posList, kmerMatrix)
+        
+        return [('{0:.2f}'.format(tm), True) for tm in thermo.tmMatrix(kmerMatrix).tolist()]
+    
+    def checkWindows(self, kmerList, posList, seq):
+        return [('{0:.2f}'.format(tm), True) for tm in thermo.tmWindows(seq, len(seq) - len(kmerList) + 1).tolist()]
 
 # Class AnnoGene (Determine if k-mer is genic)
 class AnnoGene(AnnoElement):
+    
+    cacheable = False  # Depends on the k-mer position
+    
     def __init__(self, kSize, geneFileName, filterNonGenic=True):
         AnnoElement.__init__(self, 'Gene', 0)
         
@@ -317,6 +697,127 @@ class AnnoGene(AnnoElement):
         
         geneFile.close()
     
+# Class AnnoCache (Results of cacheable annotations by k-mer)
+# An in-memory LRU cache backed by an optional SQLite file that persists between runs. Keys are
+# prefixed with a version of the annotation profile, so runs with other annotations or parameters
+# share the file without sharing results. Results are stored as JSON (tuples as arrays), so reading
+# a cache file never runs code from it.
+class AnnoCache:
+    def __init__(self, annoList, fileName=None, size=ANNO_CACHE_SIZE):
+        
+        self.annoList = [anno for anno in annoList if anno.cacheable]
+        self.size = size
+        
+        profile = '\n'.join([str(ANNO_CACHE_VERSION)] + [anno.profile() for anno in self.annoList])
+        self.version = hashlib.sha1(profile.encode()).hexdigest()[:16]
+        
+        self.memory = collections.OrderedDict()
+        
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+        
+        self.db = None
+        
+        if fileName is not None:
+            self.db = sqlite3.connect(fileName)
+            self.db.execute('CREATE TABLE IF NOT EXISTS anno (key TEXT PRIMARY KEY, result TEXT)')
+    
+    # Get a list of the results (list of annotation results) of each k-mer, or None for k-mers not
+    # found.
+    def get(self, kmerList):
+        
+        resultList = [self.memory.get(kmer) for kmer in kmerList]
+        
+        for (kmer, result) in zip(kmerList, resultList):
+            if result is not None:
+                self.memory.move_to_end(kmer)
+        
+        self.memoryHits += sum(1 for result in resultList if result is not None)
+        
+        # Look up the rest on disk
+        if self.db is not None:
+            missKmers = list({kmer for (kmer, result) in zip(kmerList, resultList) if result is None})
+            diskResult = {}
+            
+            for i in range(0, len(missKmers), CACHE_QUERY_SIZE):
+                keyList = ['{0}:{1}'.format(self.version, kmer) for kmer in missKmers[i:(i + CACHE_QUERY_SIZE)]]
+                
+                for (key, result) in self.db.execute('SELECT key, result FROM anno WHERE key IN ({0})'.format(','.join('?' * len(keyList))), keyList):
+                    try:
+                        diskResult[key[(len(self.version) + 1):]] = [tuple(annoResult) if isinstance(annoResult, list) else annoResult for annoResult in json.loads(result)]
+                    
+                    # Unreadable results are misses (checked again and replaced)
+                    except (TypeError, ValueError):
+                        pass
+            
+            for (i, kmer) in enumerate(kmerList):
+                if resultList[i] is None and kmer in diskResult:
+                    resultList[i] = diskResult[kmer]
+                    self.diskHits += 1
+            
+            self.__addMemory(diskResult)
+        
+        self.misses += sum(1 for result in resultList if result is None)
+        
+        return resultList
+    
+    # Add a dictionary of results by k-mer.
+    def put(self, kmerResult):
+        
+        self.__addMemory(kmerResult)
+        
+        if self.db is not None:
+            self.db.executemany('INSERT OR REPLACE INTO anno VALUES (?, ?)', [('{0}:{1}'.format(self.version, kmer), json.dumps(result)) for (kmer, result) in kmerResult.items()])
+            self.db.commit()
+    
+    def close(self):
+        
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+    
+    def __addMemory(self, kmerResult):
+        
+        for (kmer, result) in kmerResult.items():
+            self.memory[kmer] = result
+            self.memory.move_to_end(kmer)
+        
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+# Function: checkCached
+# Check a list of k-mers with the annotations of a cache. Only k-mers not found in the cache are
+# checked (once each, as a batch), and their results are added to it. Returns a list of check
+# results for each annotation of cache.annoList.
+def checkCached(cache, kmerList, posList):
+    
+    # Look up each k-mer once (repeats in the list are memory hits)
+    firstIndex = {}
+    
+    for (i, kmer) in enumerate(kmerList):
+        firstIndex.setdefault(kmer, i)
+    
+    uniqueKmers = list(firstIndex.keys())
+    kmerResult = dict(zip(uniqueKmers, cache.get(uniqueKmers)))
+    
+    cache.memoryHits += len(kmerList) - len(uniqueKmers)
+    
+    # Check k-mers not found
+    missKmers = [kmer for kmer in uniqueKmers if kmerResult[kmer] is None]
+    
+    if len(missKmers) > 0:
+        missPos = [posList[firstIndex[kmer]] for kmer in missKmers]
+        missMatrix = kmerMatrix(missKmers)
+        
+        missRetList = [anno.checkBatch(missKmers, missPos, missMatrix) for anno in cache.annoList]
+        missResult = {kmer: [retList[i] for retList in missRetList] for (i, kmer) in enumerate(missKmers)}
+        
+        cache.put(missResult)
+        kmerResult.update(missResult)
+    
+    return [[kmerResult[kmer][i] for kmer in kmerList] for i in range(len(cache.annoList))]
+
 # Main
 if (__name__ == '__main__'):
     
@@ -330,13 +831,28 @@ if (__name__ == '__main__'):
                         help='When filtering by a gene file, annotate and alter scores (default).')
     
     parser.add_argument('-c', '--conservation', dest='consFileName', default=None,
-                        help='File of k-mers and conservation scores.')
+                        help='File of k-mers and conservation scores, or a conservation store or sketch from conservation.py.')
+    
+    parser.add_argument('-d', '--cachedb', dest='cacheFileName', default=None,
+                        help='SQLite file of cached annotation results kept between runs (implies --cache).')
+    
+    parser.add_argument('-e', '--cache', dest='cache', default=False, action='store_true',
+                        help='Cache annotation results by k-mer, so repeated k-mers are annotated once. Unseen k-mers are annotated as a batch (not as windows).')
+    
+    parser.add_argument('-E', '--nocache', dest='cache', action='store_false',
+                        help='Annotate every k-mer (default).')
     
     parser.add_argument('-g', '--gene', dest='geneFileName', default=None,
                         help='Gene file name')
     
     parser.add_argument('-i', '--in', dest='inFileName', required=True,
-                        help='Input file name. A list of k-mers with no counts.')
+                        help='Input file name. A list of k-mers with no counts (CSV or a columnar k-mer table from kfilter.py).')
+    
+    parser.add_argument('-m', '--tm', dest='tm', default=False, action='store_true',
+                        help='Add a nearest-neighbour melting temperature column (used by the Tm options of parser.py).')
+    
+    parser.add_argument('-M', '--notm', dest='tm', action='store_false',
+                        help='Do not add a melting temperature column (default).')
     
     parser.add_argument('-o', '--out', dest='outFileName', required=True,
                         help='Output file name.')
@@ -353,12 +869,27 @@ if (__name__ == '__main__'):
     parser.add_argument('-S', '--noscore', dest='filtScore', action='store_false',
                         help='Do not write an additional column for the score regardless of disqualifying filters (default).')
     
+    parser.add_argument('-t', '--thermo', dest='thermo', default=False, action='store_true',
+                        help='Replace the self-complementarity filter with nearest-neighbour self-dimer, 3\' self-dimer and hairpin dG filters.')
+    
+    parser.add_argument('-T', '--nothermo', dest='thermo', action='store_false',
+                        help='Filter self-complementary k-mers by shared 3-mers (default).')
+    
     parser.add_argument('-v', '--verbose', dest='verbose', default=False, action='store_true',
                         help='Set verbose output.')
     
     parser.add_argument('-V', '--noverbose', dest='verbose', action='store_false',
                         help='Unset verbose output (default).')
     
+    parser.add_argument('-w', '--window', dest='window', default=False, action='store_true',
+                        help='Annotate consecutive k-mers as windows of their contiguous sequence with prefix sums and run arrays.')
+    
+    parser.add_argument('-W', '--nowindow', dest='window', action='store_false',
+                        help='Annotate each k-mer separately (default).')
+    
+    parser.add_argument('-z', '--cachesize', dest='cacheSize', default=ANNO_CACHE_SIZE, type=int,
+                        help='Number of k-mers in the in-memory annotation cache (default {0}).'.format(ANNO_CACHE_SIZE))
+    
     args = parser.parse_args()
     
     verbose = args.verbose
@@ -370,11 +901,24 @@ if (__name__ == '__main__'):
     annoList.append(AnnoEndGC())
     annoList.append(AnnoDiNuc())
     annoList.append(AnnoHomoPol())
-    annoList.append(AnnoSelfComp())
+    
+    structCache = StructureCache()
+    
+    if args.thermo:
+        annoList.append(AnnoSelfDimer(structCache))
+        annoList.append(AnnoEndDimer(structCache))
+        annoList.append(AnnoHairpin(structCache))
+    else:
+        annoList.append(AnnoSelfComp())
+    
     #annoList.append(AnnoReverseKmer())
     #annoList.append(AnnoPos17to19AUCount())
     annoList.append(AnnoGC40to60())
     annoList.append(GC_Content())
+    
+    if args.tm:
+        annoList.append(AnnoTm())
+    
     #annoList.append(AnnoRestrictionSites())
     #annoList.append(Anno7GCRun())
     
@@ -382,8 +926,11 @@ if (__name__ == '__main__'):
         consFilter = AnnoCons(args.consFileName)
         annoList.append(consFilter)
         
+        if consFilter.consScores.isEstimate:
+            print('{0}: Warning: {1}'.format(sys.argv[0], consFilter.consScores.estimateNote()), file=sys.stderr)
+        
         if not args.annotateOnly:
-            annoList.append(AnnoConsFilter(consFilter.consDict))
+            annoList.append(AnnoConsFilter(consFilter.consScores))
     
     if args.geneFileName is not None:
         annoList.append(AnnoGene(21, args.geneFileName, not args.annotateOnly))
@@ -395,6 +942,19 @@ if (__name__ == '__main__'):
     
     if maxScore == 0:
         maxScore = 1
+    
+    # Open annotation cache
+    annoCache = None
+    
+    if args.cache or args.cacheFileName is not None:
+        if (verbose and args.cacheFileName is not None):
+            print('Opening annotation cache: {0}'.format(args.cacheFileName))
+        
+        try:
+            annoCache = AnnoCache(annoList, args.cacheFileName, args.cacheSize)
+        
+        except sqlite3.Error as ex:
+            err('Error opening annotation cache "{0}": {1}'.format(args.cacheFileName, ex), ERR_IO)
  
     # Open input file
     if (verbose):
@@ -402,7 +962,7 @@ if (__name__ == '__main__'):
         print('Opening input file: {0}'.format(args.inFileName))
     
     try:
-        inFile = open(args.inFileName, 'r')
+        inFile = open(args.inFileName, 'rb')
 
     except OSError as ex:
         err('Error opening input file "{0}": {1}'.format(args.outFileName, ex.strerror), ERR_IO)
@@ -437,104 +997,118 @@ if (__name__ == '__main__'):
     else:
         outFile.write(',Rev Score\n')
 
-    # Read each line
-    for line in inFile:
-        tok = line.strip().split(',')
-        score = 0
-        disqualify = False
-                
-        if (len(tok) < 2):
-            continue
+    # Read lines in batches
+    for batch in batchRows(readKmerRows(inFile)):
+        kmerList = [tok[0].upper().replace('T', 'T') for tok in batch]
+        revKmerList = revComplList(kmerList)
+        positionList = [int(tok[2]) for tok in batch]
         
-        kmer = tok[0].upper().replace('T', 'T')
-        revKmer = revComplStr(kmer)
-        filterPass = tok[1]
-        position = int(tok[2])
+        # Check k-mers of the batch
+        structCache.clear()
         
-        if (filterPass == '0'):
-            disqualify=True
+        fwdMatrix = kmerMatrix(kmerList)
+        revMatrix = kmerMatrix(revKmerList)
         
-
-        outFile.write('{0},{1},{2},{3}'.format(kmer, revComplStr(kmer), position, 'T' if filterPass == '1' else 'F'))
-       
-        # Write filter results (fwd primer)
-        for anno in annoList:
-            annoRet = anno.check(kmer, position)
+        if annoCache is not None:
             
-            if isinstance(annoRet, tuple):
-                # Returned tuple
-                if isinstance(annoRet[1], bool):
-                    annoScore = (annoRet[0], 0, annoRet[1])
-                else:
-                    annoScore = (annoRet[0], annoRet[1], True)
-            else:
-                # Returned score or boolean
-                if isinstance(annoRet, bool):
-                    annoScore = ('T' if annoRet else 'F', 0, annoRet)
-                else:
-                    annoScore = (str(annoRet), annoRet, True)
+            # Check cacheable annotations through the cache and the others for every k-mer
+            fwdCached = iter(checkCached(annoCache, kmerList, positionList))
+            revCached = iter(checkCached(annoCache, revKmerList, positionList))
             
-            # Write and increment score
-            outFile.write(',{0}'.format(annoScore[0]))
-            score = 0
+            fwdRetList = [next(fwdCached) if anno.cacheable else anno.checkBatch(kmerList, positionList, fwdMatrix) for anno in annoList]
+            revRetList = [next(revCached) if anno.cacheable else anno.checkBatch(revKmerList, positionList, revMatrix) for anno in annoList]
+        
+        elif args.window and fwdMatrix is not None and isBase(fwdMatrix, 'ACGT').all():
+            
+            # Check windows of contiguous sequence. Reverse k-mers of a segment are windows of its
+            # reverse complement in reverse order.
+            fwdRetList = [[] for anno in annoList]
+            revRetList = [[] for anno in annoList]
             
-            # Check disqualify flag
-            if not annoScore[2]:
-                disqualify = True
+            for (start, end) in kmerSegments(fwdMatrix, positionList):
+                seq = np.concatenate((fwdMatrix[start], fwdMatrix[(start + 1):end, -1]))
+                revSeq = complBase[seq][::-1]
                 
-        score /= maxScore
+                for (anno, fwdRet, revRet) in zip(annoList, fwdRetList, revRetList):
+                    fwdRet.extend(anno.checkWindows(kmerList[start:end], positionList[start:end], seq))
+                    revRet.extend(anno.checkWindows(revKmerList[start:end][::-1], positionList[start:end][::-1], revSeq)[::-1])
         
-        # Correct score
-        if (disqualify):
-            filteredScore = 0
         else:
-            filteredScore = score
+            fwdRetList = [anno.checkBatch(kmerList, positionList, fwdMatrix) for anno in annoList]
+            revRetList = [anno.checkBatch(revKmerList, positionList, revMatrix) for anno in annoList]
         
-        # Write score
-        if (filtScore):
-            outFile.write(',{0},{1}'.format(filteredScore, score))
-        else:
-            outFile.write(',{0}'.format(filteredScore))
-    
-		# Write filter results (rev primer)
-        score = 0
-        disqualify = False
-        
-        for anno in annoList:
-            annoRet = anno.check(revKmer, position)
+        for (row, tok) in enumerate(batch):
+            score = 0
+            disqualify = False
             
-            if isinstance(annoRet, tuple):
-                # Returned tuple
-                if isinstance(annoRet[1], bool):
-                    annoScore = (annoRet[0], 0, annoRet[1])
-                else:
-                    annoScore = (annoRet[0], annoRet[1], True)
+            kmer = kmerList[row]
+            filterPass = tok[1]
+            position = positionList[row]
+            
+            if (filterPass == '0'):
+                disqualify=True
+            
+            outFile.write('{0},{1},{2},{3}'.format(kmer, revKmerList[row], position, 'T' if filterPass == '1' else 'F'))
+            
+            # Write filter results (fwd primer)
+            for annoRet in [retList[row] for retList in fwdRetList]:
+                annoScore = getAnnoScore(annoRet)
+                
+                # Write and increment score
+                outFile.write(',{0}'.format(annoScore[0]))
+                score = 0
+                
+                # Check disqualify flag
+                if not annoScore[2]:
+                    disqualify = True
+            
+            score /= maxScore
+            
+            # Correct score
+            if (disqualify):
+                filteredScore = 0
             else:
-                # Returned score or boolean
-                if isinstance(annoRet, bool):
-                    annoScore = ('T' if annoRet else 'F', 0, annoRet)
-                else:
-                    annoScore = (str(annoRet), annoRet, True)
+                filteredScore = score
+            
+            # Write score
+            if (filtScore):
+                outFile.write(',{0},{1}'.format(filteredScore, score))
+            else:
+                outFile.write(',{0}'.format(filteredScore))
             
-            # Write and increment score
-            outFile.write(',{0}'.format(annoScore[0]))
-            score += annoScore[1]
+            # Write filter results (rev primer)
+            score = 0
+            disqualify = False
             
-            # Check disqualify flag
-            if not annoScore[2]:
-                disqualify = True
+            for annoRet in [retList[row] for retList in revRetList]:
+                annoScore = getAnnoScore(annoRet)
                 
-        score /= maxScore
-        
-        # Correct score
-        if (disqualify):
-            filteredScore = 0
-        else:
-            filteredScore = score
+                # Write and increment score
+                outFile.write(',{0}'.format(annoScore[0]))
+                score += annoScore[1]
+                
+                # Check disqualify flag
+                if not annoScore[2]:
+                    disqualify = True
+            
+            score /= maxScore
+            
+            # Correct score
+            if (disqualify):
+                filteredScore = 0
+            else:
+                filteredScore = score
+            
+            # Write score
+            outFile.write(',{0}\n'.format(filteredScore))
+    
+    # Close cache
+    if annoCache is not None:
+        if (verbose):
+            print('Annotation cache: {0} memory hits, {1} disk hits, {2} misses'.format(annoCache.memoryHits, annoCache.diskHits, annoCache.misses))
         
-        # Write score
-        outFile.write(',{0}\n'.format(filteredScore))
-		
+        annoCache.close()
+    
     # Close files
     if (verbose):
         print('Closing input file')